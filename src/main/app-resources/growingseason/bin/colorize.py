@@ -6,6 +6,7 @@ import re
 from glob import glob
 from osgeo import gdal, osr
 from osgeo.gdalconst import *
+import gtiff_profiles
 
 
 env = os.environ
@@ -16,7 +17,7 @@ if env['USER'] == 'mapred':
     def LOGINFO(x): ciop.log("INFO", "Cp/ECHO:" + x)
     LOGINFO(" Using Cioppy tools")
     copy = lambda pths, dst: ciop.copy(pths, dst, extract=False)
-    # getparam = ciop.getparam
+    getparam = ciop.getparam
     def publish(pths):
         if isinstance(pths, basestring):
             pths = [pths]
@@ -33,7 +34,7 @@ else:
         'othreshold': 0.5,
         'ethreshold': 0.7
     }
-    # def getparam(x): return params[x]
+    def getparam(x): return params[x]
     def copy(pths, dst): 
         if isinstance(pths, basestring):
             pths = [pths]
@@ -48,6 +49,13 @@ else:
             LOGINFO("Publishing path " + pth)
     permadir = env['HOME'] + '/src/SenSyF/s2/growingseason/permanent/'
 
+def safe_getparam(x, default):
+    try:
+        rval = getparam(x)
+    except:
+        return default
+    return rval
+
 def mkdir_p(path):
     try:
         junk = os.listdir(path)
@@ -56,7 +64,7 @@ def mkdir_p(path):
         mkdir_p(head)
         os.mkdir(path)
 
-def colorize(fname, dstdir):
+def colorize(fname, dstdir, profile=gtiff_profiles.default_profile):
     LOGINFO("Colorizing " + fname)
     try:
         product_type = re.match(r'GS_(\w+)_(\d{4})\.tiff', fname).groups()[0]
@@ -70,9 +78,10 @@ def colorize(fname, dstdir):
 
     src_ds = gdal.Open('tmp.tiff')
     vrt = gdal.Open(permadir + product_type + '.vrt')
-    driver = gdal.GetDriverByName('GTiff')
+    # Put the file together in memory, and write it once with the profile
+    driver = gdal.GetDriverByName('MEM')
 
-    dst_ds = driver.CreateCopy(fname, vrt, 0)
+    dst_ds = driver.CreateCopy('', vrt, 0)
 
     for tag, val in src_ds.GetMetadata().iteritems():
         dst_ds.SetMetadataItem(tag, val)
@@ -80,7 +89,19 @@ def colorize(fname, dstdir):
     dst_rb = dst_ds.GetRasterBand(1)
     src_rb = src_ds.GetRasterBand(1)
     dst_rb.WriteArray(src_rb.ReadAsArray())
-    
+
+    # Products of a threshold sweep have a band per threshold; GeoTIFF
+    # only keeps the color table of a single band product
+    for i in range(2, src_ds.RasterCount + 1):
+        dst_ds.AddBand(GDT_Byte)
+        dst_rb = dst_ds.GetRasterBand(i)
+        src_rb = src_ds.GetRasterBand(i)
+        dst_rb.SetDescription(src_rb.GetDescription())
+        dst_rb.WriteArray(src_rb.ReadAsArray())
+    dst_rb = None
+
+    out_ds = gtiff_profiles.save_copy(fname, dst_ds, profile)
+    out_ds = None
     dst_ds = None
     src_ds = None
     os.unlink('tmp.tiff')
@@ -92,6 +113,9 @@ def cluster_main():
     mkdir_p(srcdir)
     mkdir_p(dstdir)
 
+    profile = gtiff_profiles.check_profile(
+        safe_getparam('output-profile', '') or gtiff_profiles.default_profile)
+
     os.chdir(srcdir)
 
     for line in sys.stdin:
@@ -99,12 +123,16 @@ def cluster_main():
         fname = os.path.basename(url)
 
         copy(url, srcdir)
-        colorize(fname, dstdir)
+        colorize(fname, dstdir, profile)
     publish(glob(dstdir + '/*.tiff'))
 
 def cmdline_main(args):
+    profile = gtiff_profiles.default_profile
+    if args and args[0] == '-p':
+        profile = gtiff_profiles.check_profile(args[1])
+        args = args[2:]
     for fname in args:
-        colorize(fname, '.')
+        colorize(fname, '.', profile)
 
 
 if __name__ == '__main__':
@@ -3,6 +3,8 @@
 import sys
 import os
 import re
+import heapq
+import shutil
 from collections import defaultdict
 
 env = os.environ
@@ -15,7 +17,7 @@ if env['USER'] == 'mapred':
     LOGINFO(" Using Cioppy tools")
     def copy(url, dst):
         LOGINFO("Copying <{0}> to <{1}>".format(url, dst))
-        ciop.copy(pths, dst, extract=False)
+        ciop.copy(url, dst, extract=False)
     getparam = ciop.getparam
     def publish(pths):
         if isinstance(pths, basestring):
@@ -26,12 +28,13 @@ if env['USER'] == 'mapred':
 else:
     def LOGINFO(x): print("[INFO]ECHO:" + x)
     def LOGERROR(x): print("[ERROR]ECHO:" + x)
-    def copy(pths, dst): 
-        if isinstance(pths, basestring):
-            pths = [pths]
-        for pth in pths:
-            LOGINFO("Copying <{0}> to <{1}>".format(pth, dst))
-            shutil.copy(pth, dst)
+    params = {
+        'batches': 0
+    }
+    def getparam(x): return params[x]
+    def copy(pth, dst):
+        LOGINFO("Copying <{0}> to <{1}>".format(pth, dst))
+        shutil.copy(pth, dst)
     def publish(pths, **kwargs):
         if 'recursive' in kwargs:
             pths = [os.path.join(pths, x) for x in os.listdir(pths)]
@@ -40,11 +43,98 @@ else:
         for pth in pths:
             LOGINFO("Publishing path " + pth)
 
-
+def safe_getparam(x, default):
+    try:
+        rval = getparam(x)
+    except:
+        return default
+    return rval
+
+# Tiles with no land, left out by the tiling tasks, see sensyf-tile -mask
+pruned_fname = 'pruned_tiles.txt'
+
+# Number of products and of bytes of each tile of a tiling task, and its
+# fraction of land, see sensyf-tile
+costs_fname = 'tile_costs.txt'
+
+# The onset and end date windows of the tiling tasks, see run_map_tiling.
+# They head every list handed to the processing stage, after window_tag,
+# so that it computes the seasons over the same windows as the tiles were
+# cut to.
+windows_fname = 'date_windows.txt'
+window_tag = '#window'
+
+# Estimated cost of a tile, in bytes read: every product of the tile is a
+# file to open, worth scene_cost bytes, and computing on the land pixels
+# takes compute_share times as long as reading them (other pixels are
+# skipped, see compact-fraction in s2_processtile.py).  Tiles with no land
+# fraction are taken as all land.
+scene_cost = 1 << 16
+compute_share = 2.0
+
+def read_lists(urls, dstdir):
+    '''Copy the lists written by the tiling tasks, and return their lines.'''
+
+    lines = []
+    for i, url in enumerate(urls):
+        tmpdir = os.path.join(dstdir, 'lists', str(i))
+        try: os.makedirs(tmpdir)
+        except OSError: pass
+        copy(url, tmpdir)
+        path = os.path.join(tmpdir, os.path.basename(url))
+        lines.extend(line for line in open(path) if line.strip())
+    if urls:
+        shutil.rmtree(os.path.join(dstdir, 'lists'))
+    return lines
+
+def tile_costs(lines, groups):
+    '''Estimate the cost of the tiles in groups from the costs lists.
+
+    The products and bytes of a tile are summed over the tiling tasks.
+    Tiles missing from the lists are costed as the average tarball.'''
+
+    counts = {}
+    for line in lines:
+        k, products, nbytes, land = line.split()
+        land = 1.0 if land == '-' else float(land)
+        old = counts.get(k, (0, 0, land))
+        counts[k] = (old[0] + int(products), old[1] + int(nbytes), land)
+
+    costs = {}
+    for k, (products, nbytes, land) in counts.iteritems():
+        if k in groups:
+            costs[k] = products * scene_cost + nbytes * (1 + compute_share * land)
+
+    per_tarball = 1.0
+    if costs:
+        per_tarball = sum(costs.values()) / sum(len(groups[k]) for k in costs)
+    for k in groups:
+        if k not in costs:
+            costs[k] = len(groups[k]) * per_tarball
+    return costs
+
+def balance(costs, nbatches):
+    '''Pack the tiles into nbatches batches of about the same cost, longest
+    processing time first: every tile in turn, from the costliest, goes to
+    the batch with the least cost so far.
+
+    Returns the batches, as lists of tiles from the costliest, and their
+    costs.'''
+
+    batches = [[] for i in range(nbatches)]
+    loads = [(0.0, i) for i in range(nbatches)]
+    for k in sorted(costs, key=lambda k: (-costs[k], k)):
+        load, i = heapq.heappop(loads)
+        batches[i].append(k)
+        heapq.heappush(loads, (load + costs[k], i))
+    return batches, [load for load, i in sorted(loads, key=lambda x: x[1])]
 
 def main(fd, dstdir):
 
     groups = defaultdict(list)
+    pruned_urls = []
+    costs_urls = []
+    windows_urls = []
 
     try: os.mkdir(dstdir)
     except OSError: pass
@@ -52,8 +142,18 @@ def main(fd, dstdir):
 
     for line in fd:
         dname, fname = os.path.split(line.rstrip())
+        if fname == pruned_fname:
+            pruned_urls.append(line.rstrip())
+            continue
+        if fname == costs_fname:
+            costs_urls.append(line.rstrip())
+            continue
+        if fname == windows_fname:
+            windows_urls.append(line.rstrip())
+            continue
         parts = fname.split('.', 1)
-        if parts[1] != 'tar.gz' or not re.match(r'\d+_\d+', parts[0]):
+        # A tarball of the tile, or a stack (see the tileformat parameter)
+        if parts[1] not in ('tar.gz', 'tar', 'tif') or not re.match(r'\d+_\d+', parts[0]):
             logerror("Unexpected input url: <{0}>".format(line.rstrip()))
             continue
         # if fname[:4] != 'ndvi': continue
@@ -61,10 +161,53 @@ def main(fd, dstdir):
         # key = parts[-5], parts[-4]
         groups[parts[0]].append(line)
 
+    # The tiling tasks share the mask, so they prune the same tiles; drop
+    # any tile of a pruned ID nonetheless published, which would be merged
+    # with its fill
+    pruned = dict((line.split()[0], line) for line in read_lists(pruned_urls, dstdir))
+    for k in pruned:
+        if groups.pop(k, None) is not None:
+            LOGINFO("Dropped pruned tile " + k)
+    if pruned_urls:
+        fname = os.path.join(dstdir, pruned_fname)
+        fd = open(fname, 'w')
+        fd.writelines(pruned[k] for k in sorted(pruned))
+        fd.close()
+        LOGINFO("{0} tiles with no land left out".format(len(pruned)))
+        publish(fname)
+
+    # The tiling tasks share their parameters, so their windows are the same
+    windows = sorted(set(line.strip() for line in read_lists(windows_urls, dstdir)))
+    if len(windows) > 1:
+        raise ValueError("Tiling tasks with different date windows: " + ", ".join(windows))
+    if windows:
+        LOGINFO("Date windows " + windows[0])
+    header = ['{0} {1}\n'.format(window_tag, w) for w in windows]
+
+    # With batches, the lists of the tarballs of several tiles are published
+    # together, in batches of about the same cost, for the s2 tasks to take
+    # the same time; s2_processtile splits them by tile again
+    nbatches = min(int(safe_getparam('batches', 0)), len(groups))
+    if nbatches > 0:
+        costs = tile_costs(read_lists(costs_urls, dstdir), groups)
+        batches, loads = balance(costs, nbatches)
+        LOGINFO("{0} tiles in {1} batches, costs from {2:.3g} to {3:.3g}".format(
+                len(groups), nbatches, min(loads), max(loads)))
+        for i, batch in enumerate(batches):
+            fname = os.path.join(dstdir, 'batch_{0}.urls'.format(i))
+            fd = open(fname, 'w')
+            fd.writelines(header)
+            for k in batch:
+                fd.writelines(groups[k])
+            fd.close()
+            publish(fname)
+        return
+
     for k in groups.iterkeys():
         # fname = 'tile_' + ('_'.join(k)) + '.urls'
         fname = os.path.join(dstdir, 'tile_' + k + '.urls')
         fd = open(fname, 'w')
+        fd.writelines(header)
         fd.writelines(groups[k])
         fd.close()
         publish(fname)
@@ -0,0 +1,126 @@
+#!/opt/anaconda/bin/python
+
+'''GeoTIFF creation profiles shared by the growing season stages.
+
+The products are byte rasters which are mostly constant (water, no data,
+a handful of day classes), so compressing them makes them many times
+smaller, both to publish and to copy between the stages.  A profile is
+named by the output-profile job parameter:
+
+  none    -- uncompressed strips, as GDAL writes by default
+  deflate -- DEFLATE compressed strips with a predictor
+  lzw     -- LZW compressed strips with a predictor
+  tiled   -- DEFLATE compressed 256 x 256 internal tiles
+  cog     -- Cloud-Optimized GeoTIFF: tiled, with internal overviews
+
+The overviews of a COG are only of use in the merged products; the tiles
+of the products, which the merge reads and throws away, are written with
+tile_profile(), which leaves them out.
+
+Run as a script, prints the creation options of a profile as arguments
+for the GDAL utilities:
+
+  gtiff_profiles.py PROFILE [Byte|Int16|Float32]'''
+
+import os
+import sys
+from osgeo import gdal
+from osgeo.gdalconst import *
+
+default_profile = 'deflate'
+block_size = 256                # Of internal tiles, and smallest overview
+
+profiles = {
+    'none':    [],
+    'deflate': ['COMPRESS=DEFLATE', 'PREDICTOR={predictor}', 'ZLEVEL=6'],
+    'lzw':     ['COMPRESS=LZW', 'PREDICTOR={predictor}'],
+    'tiled':   ['COMPRESS=DEFLATE', 'PREDICTOR={predictor}', 'ZLEVEL=6',
+                'TILED=YES', 'BLOCKXSIZE={block}', 'BLOCKYSIZE={block}'],
+    'cog':     ['COMPRESS=DEFLATE', 'PREDICTOR={predictor}', 'ZLEVEL=6',
+                'TILED=YES', 'BLOCKXSIZE={block}', 'BLOCKYSIZE={block}'],
+}
+
+type_names = {'Byte': GDT_Byte, 'Int16': GDT_Int16, 'Float32': GDT_Float32}
+
+def check_profile(profile):
+    if profile not in profiles:
+        raise ValueError("Unknown output profile " + repr(profile))
+    return profile
+
+def tile_profile(profile):
+    '''Profile of the intermediate files of the profile: a COG is written
+    tiled, without the overviews and the copy finish() makes of it.'''
+
+    return 'tiled' if check_profile(profile) == 'cog' else profile
+
+def creation_options(profile, gdt=GDT_Byte):
+    '''GDAL creation options of the GeoTIFF profile for data of type gdt.
+
+    Integer data is compressed with horizontal differencing, floating
+    point data with the floating point predictor.'''
+
+    predictor = 3 if gdt in (GDT_Float32, GDT_Float64) else 2
+    return [opt.format(predictor=predictor, block=block_size)
+            for opt in profiles[check_profile(profile)]]
+
+def create(fname, xsize, ysize, gdt, profile, bands=1):
+    '''Create a GeoTIFF, to be written with the profile.
+
+    A COG cannot be written piecewise; the file is created tiled and
+    compressed, and finish() adds the overviews once it is complete.'''
+
+    driver = gdal.GetDriverByName('GTiff')
+    return driver.Create(fname, xsize, ysize, bands, gdt, creation_options(profile, gdt))
+
+def overview_levels(xsize, ysize):
+    levels = []
+    factor = 2
+    while max(xsize, ysize) / factor >= block_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+def save_copy(fname, src_ds, profile, resampling='NEAREST'):
+    '''Write src_ds to fname as a GeoTIFF with the profile.
+
+    With the cog profile, overviews are built on src_ds, which must then
+    be writable: an in-memory dataset, or a file of its own.'''
+
+    gdt = src_ds.GetRasterBand(1).DataType
+    options = creation_options(profile, gdt)
+    if profile == 'cog':
+        levels = overview_levels(src_ds.RasterXSize, src_ds.RasterYSize)
+        if levels:
+            src_ds.BuildOverviews(resampling, levels)
+        options.append('COPY_SRC_OVERVIEWS=YES')
+    driver = gdal.GetDriverByName('GTiff')
+    return driver.CreateCopy(fname, src_ds, 0, options)
+
+def finish(fname, profile, rewrite=False, resampling='NEAREST'):
+    '''Complete a file made by create() once all of it has been written.
+
+    Blocks written over again, when the file is written in windows which
+    do not line up with its strips or tiles, leave unused space behind in
+    a compressed file.  With rewrite, the file is copied anew to reclaim
+    it.  A COG is always copied anew, with its overviews.'''
+
+    if profile == 'cog' or (rewrite and profile != 'none'):
+        tmp_fname = fname + '.tmp'
+        os.rename(fname, tmp_fname)
+        src_ds = gdal.Open(tmp_fname, GA_Update)
+        dst_ds = save_copy(fname, src_ds, profile, resampling)
+        dst_ds = None
+        src_ds = None
+        os.unlink(tmp_fname)
+        if os.path.exists(tmp_fname + '.ovr'): os.unlink(tmp_fname + '.ovr')
+
+def main(args):
+    if not 1 <= len(args) <= 2:
+        sys.stderr.write(__doc__.split('\n\n')[-1] + '\n')
+        return 2
+    gdt = type_names[args[1]] if len(args) > 1 else GDT_Byte
+    print ' '.join('-co ' + opt for opt in creation_options(args[0], gdt))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,176 @@
+#!/opt/anaconda/bin/python
+
+'''Merge the tiles of a growing season product into one colorized GeoTIFF.
+
+The tiles, GS_TYPE_YEAR_ID.tiff made by s2_processtile.py, are mosaicked
+as gdal_merge.py would, into the union of their extents with the pixel
+size of the first tile, later tiles over earlier ones and zero where
+there is none.  The tiles listed in PRUNED_LIST are filled with water
+first: sensyf-tile -mask leaves out the tiles which are all water under
+the land mask, and lists them one per line, with the tile ID, the number
+of columns and rows of the tile, and its geotransform.
+
+The output is created with the projection and band descriptions of the
+first tile, an image description of its own listing the merged tiles,
+and the color table of COLORS, a VRT edit script as in
+src/colorize_TYPE.ed, on its first band; GeoTIFF only keeps the color
+table of a single band product.  It is then written once, a row of tiles
+at a time, in the GeoTIFF profile PROFILE.
+
+Usage: merge_products.py [-p PROFILE] [-c COLORS] [-w PRUNED_LIST] OUTPUT TILE...'''
+
+import os
+import re
+import sys
+import getopt
+import numpy as np
+from osgeo import gdal, gdal_array
+from osgeo.gdalconst import *
+
+import gtiff_profiles
+
+water = 200                     # The mask value 370, see encode() in s2_processtile.py
+
+entry_pattern = re.compile(r'<Entry\s+c1="(\d+)"\s+c2="(\d+)"\s+c3="(\d+)"\s+c4="(\d+)"')
+
+def read_colors(fname):
+    '''Return the color table of the Entry elements in fname.'''
+
+    ct = gdal.ColorTable()
+    i = 0
+    for line in open(fname):
+        m = entry_pattern.search(line)
+        if m is None: continue
+        ct.SetColorEntry(i, tuple(int(c) for c in m.groups()))
+        i += 1
+    return ct
+
+def read_pruned(fname):
+    '''Return the pruned tiles as (ID, xsize, ysize, geotransform) tuples.'''
+
+    tiles = []
+    for line in open(fname):
+        fields = line.split()
+        if not fields: continue
+        tiles.append((fields[0], int(fields[1]), int(fields[2]),
+                      tuple(float(v) for v in fields[3:9])))
+    return tiles
+
+class Piece(object):
+    '''A rectangle of the output: a tile, or a pruned tile filled with water.'''
+
+    def __init__(self, xsize, ysize, tran, ds=None):
+        self.xsize, self.ysize, self.tran = xsize, ysize, tran
+        self.ds = ds
+
+    def place(self, tran):
+        '''Set the offset of the piece in the output of geotransform tran.'''
+
+        self.xoff = int((self.tran[0] - tran[0]) / tran[1] + 0.5)
+        self.yoff = int((self.tran[3] - tran[3]) / tran[5] + 0.5)
+
+    def read(self, y0, y1, bands):
+        '''The rows y0 to y1 of the output covered by the piece.'''
+
+        ys, ye = max(y0, self.yoff), min(y1, self.yoff + self.ysize)
+        if self.ds is None:
+            return ys, np.full((bands, ye - ys, self.xsize), water, np.uint8)
+        data = self.ds.ReadAsArray(0, ys - self.yoff, self.xsize, ye - ys)
+        return ys, data.reshape((-1, ye - ys, self.xsize))
+
+def out_grid(pieces):
+    '''Geotransform and size of the union of the pieces.'''
+
+    tran = pieces[0].tran
+    ulx = min(p.tran[0] for p in pieces)
+    uly = max(p.tran[3] for p in pieces)
+    lrx = max(p.tran[0] + p.tran[1] * p.xsize for p in pieces)
+    lry = min(p.tran[3] + p.tran[5] * p.ysize for p in pieces)
+    out_tran = (ulx, tran[1], 0, uly, 0, tran[5])
+    xsize = int((lrx - ulx) / tran[1] + 0.5)
+    ysize = int((lry - uly) / tran[5] + 0.5)
+    return out_tran, xsize, ysize
+
+def row_bands(pieces, ysize):
+    '''Windows of rows of the output, from the top of one row of pieces
+    to the top of the next.'''
+
+    tops = sorted(set([0] + [p.yoff for p in pieces if 0 < p.yoff < ysize]))
+    return zip(tops, tops[1:] + [ysize])
+
+def mosaic_description(first, fnames, pruned):
+    '''The image description of the mosaic of the tiles fnames and the
+    pruned tiles: the title of the product, the first line of the
+    description of the tile first, and the names of the tiles.  The rest of
+    the description of a tile, with its scenes, is of that tile only.'''
+
+    descr = first.GetMetadataItem('TIFFTAG_IMAGEDESCRIPTION') or ''
+    lines = descr.split('\n')[:1] if descr.strip() else []
+    lines.append('Mosaic of tiles: {0} merged, {1} pruned and filled with water.'.format(
+            len(fnames), len(pruned or [])))
+    lines.append('Merged tiles:')
+    lines.extend('  ' + os.path.basename(fname) for fname in fnames)
+    return '\n'.join(lines)
+
+def merge(ofname, fnames, colors=None, pruned=None, profile=gtiff_profiles.default_profile):
+    '''Merge the tiles fnames, and the pruned tiles, into ofname.'''
+
+    tiles = []
+    for fname in fnames:
+        ds = gdal.Open(fname)
+        tiles.append(Piece(ds.RasterXSize, ds.RasterYSize, ds.GetGeoTransform(), ds))
+    first = tiles[0].ds
+    fills = [Piece(xsize, ysize, tran) for _, xsize, ysize, tran in pruned or []]
+    # Water first, so that tiles listed as pruned too are kept
+    pieces = fills + tiles
+
+    tran, xsize, ysize = out_grid(tiles + fills)
+    for piece in pieces:
+        piece.place(tran)
+
+    bands = first.RasterCount
+    gdt = first.GetRasterBand(1).DataType
+    out_ds = gtiff_profiles.create(ofname, xsize, ysize, gdt, profile, bands)
+    out_ds.SetGeoTransform(tran)
+    out_ds.SetProjection(first.GetProjectionRef())
+    out_ds.SetMetadataItem('TIFFTAG_IMAGEDESCRIPTION', mosaic_description(first, fnames, pruned))
+    for i in range(1, bands + 1):
+        out_ds.GetRasterBand(i).SetDescription(first.GetRasterBand(i).GetDescription())
+    if colors is not None:
+        rb = out_ds.GetRasterBand(1)
+        rb.SetColorInterpretation(GCI_PaletteIndex)
+        rb.SetColorTable(colors)
+        rb = None
+
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(gdt)
+    for y0, y1 in row_bands(pieces, ysize):
+        data = np.zeros((bands, y1 - y0, xsize), dtype)
+        for piece in pieces:
+            if piece.yoff >= y1 or piece.yoff + piece.ysize <= y0: continue
+            ys, part = piece.read(y0, y1, bands)
+            data[:, ys - y0:ys - y0 + part.shape[1], piece.xoff:piece.xoff + piece.xsize] = part
+        for i in range(bands):
+            out_ds.GetRasterBand(i + 1).WriteArray(data[i], 0, y0)
+
+    out_ds = None               # Close and flush file
+    gtiff_profiles.finish(ofname, profile)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, 'p:c:w:')
+    except getopt.GetoptError:
+        args = []
+    if len(args) < 2:
+        sys.stderr.write(__doc__.split('\n\n')[-1] + '\n')
+        return 2
+    opts = dict(opts)
+    profile = gtiff_profiles.check_profile(opts.get('-p', gtiff_profiles.default_profile))
+    colors = read_colors(opts['-c']) if '-c' in opts else None
+    pruned = read_pruned(opts['-w']) if '-w' in opts else None
+
+    merge(args[0], args[1:], colors, pruned, profile)
+    print 'Merged {0} tiles into {1}'.format(len(args) - 1, os.path.basename(args[0]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
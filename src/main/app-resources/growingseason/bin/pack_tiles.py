@@ -0,0 +1,82 @@
+#!/opt/anaconda/bin/python
+
+'''Pack the tiles made by sensyf-tile -organize_by_tile into tarballs.
+
+Every subdirectory of DIR is a tile; it is packed into DIR/TILE.tar.gz,
+or DIR/TILE.tar with compression level 0, with the tile directory as the
+first member (see copy_and_unpack() in s2_processtile.py), and removed.
+Files are streamed into the archive one at a time, and removed as soon as
+they are in, so that a tile never takes twice its size on disk.  Several
+tiles are packed at once, in a pool of worker processes.
+
+Uncompressed tarballs are worth it when the members are compressed
+GeoTIFF files already: gzip barely shrinks them, and takes long.
+
+Usage: pack_tiles.py [-l LEVEL] [-j JOBS] DIR'''
+
+import os
+import sys
+import getopt
+import tarfile
+import multiprocessing
+
+default_level = 6               # As gzip, and tar z
+
+def tarball_name(tile, level):
+    return tile + ('.tar.gz' if level else '.tar')
+
+def pack_tile(job):
+    '''Pack the tile directory tile in dstdir, and remove it.
+
+    Returns the name of the tarball.'''
+
+    dstdir, tile, level = job
+    tiledir = os.path.join(dstdir, tile)
+    fname = os.path.join(dstdir, tarball_name(tile, level))
+    if level:
+        tf = tarfile.open(fname, 'w:gz', compresslevel=level)
+    else:
+        tf = tarfile.open(fname, 'w')
+    tf.add(tiledir, arcname=tile, recursive=False)
+    for name in sorted(os.listdir(tiledir)):
+        path = os.path.join(tiledir, name)
+        tf.add(path, arcname=os.path.join(tile, name))
+        os.unlink(path)
+    tf.close()
+    os.rmdir(tiledir)
+    return os.path.basename(fname)
+
+def pack_tiles(dstdir, level=default_level, jobs=1):
+    '''Pack every tile directory in dstdir, in jobs worker processes.'''
+
+    tiles = sorted(name for name in os.listdir(dstdir)
+                   if os.path.isdir(os.path.join(dstdir, name)))
+    work = [(dstdir, tile, level) for tile in tiles]
+    if jobs <= 1 or len(tiles) <= 1:
+        return map(pack_tile, work)
+
+    pool = multiprocessing.Pool(min(jobs, len(tiles)))
+    try:
+        return pool.map(pack_tile, work, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, 'l:j:')
+        opts = dict(opts)
+        level = int(opts.get('-l', default_level))
+        jobs = int(opts.get('-j', 1))
+    except (getopt.GetoptError, ValueError):
+        args = []
+    if len(args) != 1 or not 0 <= level <= 9 or jobs < 1:
+        sys.stderr.write(__doc__.split('\n\n')[-1] + '\n')
+        return 2
+
+    for fname in pack_tiles(args[0], level, jobs):
+        print fname
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -10,11 +10,23 @@ import tarfile
 import re
 import datetime as dt
 import time
+import hashlib
+import tempfile
+import json
+import resource
+import fcntl
+from contextlib import contextmanager
+import itertools
+import threading
+import Queue
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from glob import glob
 
 from osgeo import gdal, osr
 from osgeo.gdalconst import *
+import gtiff_profiles
 # import data_handler as dh
 
 gdal.UseExceptions()
@@ -24,6 +36,69 @@ gdal.UseExceptions()
 
 mask_fname = 'maske_sval.tiff'
 
+# Node-wide cache of remapped masks, shared between jobs and workers.
+# Set from the job parameters in cluster_main(); None disables the cache.
+mask_cachedir = None
+mask_cachesize = 512            # MB
+
+# Tiles are processed in windows of whole rows, aligned to the block size
+# of the inputs, small enough to keep the arrays of all products within
+# memory_budget MB.  Set from the job parameters; 0 processes whole tiles.
+memory_budget = 0
+
+# Node-wide cache of per-tile scene cubes, keyed on the list of tarballs of
+# the tile.  A cube holds all scenes of a tile in one memory-mapped array.
+# Set from the job parameters; None unpacks the scenes as GeoTIFF files.
+cube_cachedir = None
+cube_cachesize = 20480          # MB
+cube_fname = 'ndvi_cube.npy'
+cube_index_fname = 'ndvi_cube.json'
+
+# With unpack_scenes False, the tarballs of a tile are kept as they are and
+# GDAL reads the scenes from them through /vsitar/ paths.  The tile
+# directory then only holds an index of the scenes in the tarballs.
+unpack_scenes = True
+scene_index_fname = 'ndvi_members.json'
+
+# The tiles with no land, left out at the tiling stage (see sensyf-tile
+# -mask), are listed in this file among the tiles; it is passed on as it
+# is, for merge_tiles to fill them with water.
+pruned_fname = 'pruned_tiles.txt'
+
+# The lists of the tarballs of several tiles may come in one batch, see
+# grouping.py; the tarballs of a tile are named after it.
+batch_pattern = re.compile(r'batch_\d+\.urls$')
+tarball_pattern = re.compile(r'(\d+_\d+)\.(tar\.gz|tar|tif)$')
+
+# The onset and end date windows, set at the tiling stage only, head the
+# lists after window_tag, see grouping.py; they take the place of the
+# dates of the settings.
+window_tag = '#window'
+
+# Number of years of a tile computed concurrently by above, peak and below.
+# Every thread holds its own arrays, so the memory used grows accordingly.
+year_workers = 1
+
+# Windows with a smaller fraction of land pixels than compact_fraction are
+# processed as vectors of their land pixels, see LandPixels.  Set from the
+# job parameters; 0 processes all windows as 2-D arrays.
+compact_fraction = 0.8
+
+# Counters of the time spent and the bytes moved in the stages of a tile,
+# emitted as one JSON record per tile: with 'log' through LOGINFO, otherwise
+# appended as a line to the file metrics_sink.  Empty disables the record.
+metrics_sink = 'log'
+
+# Directory of checkpoints of the season accumulators, one subdirectory per
+# tile and year.  Set from the job parameters; None computes every year
+# from all its scenes.
+season_statedir = None
+
+# Creation profile of the GeoTIFF products and averages, see gtiff_profiles.
+# Set from the job parameters, through tile_profile: these are the tiles,
+# which the merge reads, and not the final products.
+output_profile = gtiff_profiles.default_profile
+
 #permadir = './permanent'
 
 if env['USER'] == 'mapred':
@@ -68,23 +143,194 @@ else:
             LOGINFO("Publishing path " + pth)
     permadir = os.path.join(env['HOME'], 'src/s2/growingseason/permanent')
 
-def copy_and_unpack(url, dst):
-    def _copy(url, dst):
-        fname = os.path.basename(url)
-        path = os.path.join(dst, fname)
-        copy(url, dst)
-        return path
-    flist = _copy(url, dst)
-    for url in open(flist):
-        path = _copy(url.rstrip(), dst)
+def fetch(url, dst):
+    '''Copy url into the directory dst, unless it was prefetched there.
+
+    Returns the local path.'''
+
+    path = os.path.join(dst, os.path.basename(url))
+    if not os.path.exists(path):
+        mkdir_p(dst)
+        if os.path.isfile(url):
+            shutil.copy(url, dst)       # Split from a batch, see tile_urls
+        else:
+            copy(url, dst)
+    return path
+
+def archive_dir(dst, i):
+    # Tarballs of a tile from different tasks share their name
+    return os.path.join(dst, 'archives', str(i))
+
+def read_list(flist):
+    '''The URLs of the tarballs in the list flist, and the date windows
+    (o_startdate, o_enddate, e_startdate, e_enddate) heading it, or None.'''
+
+    urls = []
+    window = None
+    for line in open(flist):
+        if line.startswith(window_tag):
+            window = tuple(line.split()[1:5])
+        elif line.strip():
+            urls.append(line.strip())
+    return urls, window
+
+def cube_dir(cachedir, flist):
+    # The scenes of the cube do not depend on the windows
+    urls = ''.join(line for line in open(flist) if not line.startswith(window_tag))
+    return os.path.join(cachedir, hashlib.sha1(urls).hexdigest())
+
+def fetch_tile(url, dst, pool=None):
+    '''Copy the list of tarballs url and the tarballs it lists into dst,
+    where copy_and_unpack finds them.  The tarballs are copied
+    concurrently in the threads of pool, if given, and are not copied at
+    all if the tile is in the cube cache.  The cube is then locked, see
+    lock_entry, so that it is not evicted before the tile is processed.
+
+    Returns the number of bytes copied, and the lock of the cube or None.'''
+
+    flist = fetch(url, dst)
+    if cube_cachedir is not None:
+        cubedir = cube_dir(cube_cachedir, flist)
+        lock = lock_entry(cubedir)
+        if os.path.exists(cubedir):
+            return path_size(dst), lock
+        lock.close()
+
+    jobs = [(url, archive_dir(dst, i)) for i, url in enumerate(read_list(flist)[0])]
+    if pool is not None:
+        pool.map(lambda job: fetch(*job), jobs)
+    else:
+        for job in jobs:
+            fetch(*job)
+    return path_size(dst), None
+
+def copy_and_unpack(url, dst, cachedir=None):
+    '''Copy and unpack the tarballs listed in url.
+
+    Files already in dst are not copied again, see fetch_tile.  With a
+    cachedir, the scenes are stacked into a cube in the cache, or taken
+    from there without copying anything if the same list of tarballs was
+    unpacked before.  Without unpack_scenes, the scenes are indexed and
+    left in the tarballs, see scene_path().  The list may also hold stacks
+    of the tile, multi-band GeoTIFF files made by sensyf-tile -stack,
+    whose bands are indexed as scenes, see stack_members().
+
+    The cube of the tile is locked, see lock_entry, until release_tile.
+
+    Returns the name of the tile and the directory holding its scenes.'''
+
+    flist = fetch(url, dst)
+
+    if cachedir is not None:
+        cubedir = cube_dir(cachedir, flist)
+        _cube_locks[cubedir] = lock_entry(cubedir)
+        try:
+            os.utime(cubedir, None)
+            tile = json.load(open(os.path.join(cubedir, cube_index_fname)))['tile']
+            LOGINFO("Using cached cube " + cubedir)
+            os.unlink(flist)
+            return tile, cubedir
+        except (OSError, IOError):
+            pass
+
+    members = {}
+    stacked = False
+    archdir = os.path.join(dst, 'archives')
+    for i, url in enumerate(read_list(flist)[0]):
+        path = fetch(url, archive_dir(dst, i))
+        if path.endswith('.tif'):
+            tile = os.path.splitext(os.path.basename(path))[0]
+            members.update(stack_members(path))
+            stacked = True
+            continue
         tf = tarfile.open(path, 'r')
         tile = tf.next().name       # Subdir is first in tarfile
-        tf.extractall(path=dst)
+        if unpack_scenes:
+            tf.extractall(path=dst)
+            for name in tf.getnames():
+                members[os.path.basename(name)] = os.path.abspath(os.path.join(dst, name))
+        else:
+            for name in tf.getnames():
+                members[os.path.basename(name)] = '/vsitar/' + os.path.join(os.path.abspath(path), name)
         tf.close()
-        os.unlink(path)
+        if unpack_scenes: os.unlink(path)
     os.unlink(flist)
-    return tile
 
+    tiledir = os.path.join(dst, tile)
+    if not unpack_scenes or stacked:
+        mkdir_p(tiledir)
+        fd = open(os.path.join(tiledir, scene_index_fname), 'w')
+        json.dump(members, fd)
+        fd.close()
+    if cachedir is None:
+        return tile, tiledir
+
+    build_cube(tiledir, cubedir, tile)
+    release_tile(tiledir)
+    rmtree(tiledir)
+    if os.path.exists(archdir): rmtree(archdir)
+    evict_lru(cachedir, cube_cachesize)
+    return tile, cubedir
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+def count(**counts):
+    '''Add counts to the metrics of the current tile, if any.'''
+
+    if _metrics is None: return
+    with _metrics_lock:
+        for key, val in counts.items():
+            _metrics[key] = _metrics.get(key, 0) + val
+
+@contextmanager
+def timed(stage, **counts):
+    '''Add the time spent in the block to stage_s in the metrics of the
+    current tile, along with counts.  Times of concurrent years add up.'''
+
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        counts[stage + '_s'] = time.time() - t0
+        count(**counts)
+
+def reset_peak_rss():
+    '''Reset the peak resident set size of the process to its current
+    size, through /proc/self/clear_refs.  Returns False where Linux does
+    not allow it.'''
+
+    try:
+        fd = open('/proc/self/clear_refs', 'w')
+        fd.write('5')
+        fd.close()
+    except (IOError, OSError):
+        return False
+    return True
+
+def peak_rss():
+    '''Peak resident set size of the process in MB, since it started or
+    since reset_peak_rss().'''
+
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    # ru_maxrss is in kB on Linux, and is never reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def emit_metrics(record):
+    if not metrics_sink: return
+    line = json.dumps(record, sort_keys=True)
+    if metrics_sink == 'log':
+        LOGINFO("METRICS " + line)
+    else:
+        fd = open(metrics_sink, 'a')
+        fd.write(line + '\n')
+        fd.close()
 
 def safe_getparam(x, default):
     try:
@@ -119,30 +365,551 @@ def encode(idays):
   return odays
 
 
+def create_template(fname, src_ds):
+    '''Create an empty GeoTIFF fname of one band on the grid of src_ds,
+    with the data type of its first band.
+
+    The templates of the tile grid only serve for their grid: a stack has a
+    band per scene, and the mask is filled and remapped anyway.'''
+
+    dst_ds = gdal.GetDriverByName('GTiff').Create(fname, src_ds.RasterXSize, src_ds.RasterYSize,
+                                                  1, src_ds.GetRasterBand(1).DataType)
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    dst_ds.SetProjection(src_ds.GetProjectionRef())
+    return dst_ds
+
 def create_remapped_mask(src_fn, mask_fn, remap_mask_fn):
 
-    copyfile(src_fn, remap_mask_fn)
+    # Through GDAL, as src_fn may be in a tarball
+    src_ds = gdal.Open(src_fn, GA_ReadOnly)
+    dst_ds = create_template(remap_mask_fn, src_ds)
     try:
         src_ds = gdal.Open(mask_fn, GA_ReadOnly)
     except RuntimeError:
         mask_fn = os.path.split(mask_fn)[-1]
         src_ds = gdal.Open(mask_fn, GA_ReadOnly)
-    dst_ds = gdal.Open(remap_mask_fn, GA_Update)
 
-    rmask = dst_ds.ReadAsArray()
-    dst_ds.GetRasterBand(1).WriteArray(0*rmask + 370)   # Fill with water
+    dst_ds.GetRasterBand(1).Fill(370)                   # Fill with water
 
     gdal.ReprojectImage(src_ds, dst_ds)
     dst_ds = None
 
+_mask_checksums = {}
+
+def mask_checksum(mask_fn):
+    if not os.path.exists(mask_fn):
+        mask_fn = os.path.split(mask_fn)[-1]
+    st = os.stat(mask_fn)
+    key = (os.path.abspath(mask_fn), st.st_size, st.st_mtime)
+    if key not in _mask_checksums:
+        md5 = hashlib.md5()
+        fd = open(mask_fn, 'rb')
+        for chunk in iter(lambda: fd.read(1 << 20), ''):
+            md5.update(chunk)
+        fd.close()
+        _mask_checksums[key] = md5.hexdigest()
+    return _mask_checksums[key]
+
+def mask_cache_key(src_fn, mask_fn):
+    '''Key of a remapped mask: the grid of the target plus the mask checksum.'''
+
+    ds = gdal.Open(src_fn, GA_ReadOnly)
+    grid = (ds.GetGeoTransform(), ds.GetProjectionRef(),
+            ds.RasterXSize, ds.RasterYSize,
+            ds.GetRasterBand(1).DataType, mask_checksum(mask_fn))
+    return hashlib.sha1(repr(grid)).hexdigest()
+
+def remove_path(pth):
+    try:
+        if os.path.isdir(pth): rmtree(pth)
+        else: os.unlink(pth)
+    except OSError:
+        pass                    # Removed by another worker
+
+def path_size(pth):
+    if not os.path.isdir(pth):
+        return os.stat(pth).st_size
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(pth):
+        for name in filenames:
+            size += os.stat(os.path.join(dirpath, name)).st_size
+    return size
+
+def lock_entry(pth):
+    '''Take a shared lock on the cache entry pth, which evict_lru leaves
+    alone while it is held, even by another process.  The entry need not
+    exist yet.
+
+    The lock is an flock on the marker pth.lock; it is released by closing
+    the returned file.'''
+
+    mkdir_p(os.path.dirname(pth))
+    while True:
+        fd = open(pth + '.lock', 'a')
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            # Unless evict_lru removed the marker meanwhile
+            if os.fstat(fd.fileno()).st_ino == os.stat(fd.name).st_ino:
+                return fd
+        except OSError:
+            pass
+        fd.close()
+
+def evict_entry(pth):
+    '''Remove the cache entry pth and its marker, unless it is locked.
+
+    Returns whether the entry was removed.'''
+
+    fd = open(pth + '.lock', 'a')
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return False            # In use, see lock_entry
+    else:
+        remove_path(pth)
+        remove_path(fd.name)
+        return True
+    finally:
+        fd.close()
+
+def evict_lru(cachedir, maxsize, keep=None):
+    '''Remove least recently used entries until the cache is below maxsize MB.
+
+    Entries are the files or directories of cachedir; their modification
+    time is their last use.  Entries ending in .tmp are being built, and
+    entries locked with lock_entry are in use; neither is evicted.
+
+    keep -- path of an entry which is never evicted'''
+
+    entries = []
+    total = 0
+    for name in os.listdir(cachedir):
+        pth = os.path.join(cachedir, name)
+        if name.endswith('.lock'): continue
+        try:
+            mtime = os.stat(pth).st_mtime
+            if name.endswith('.tmp'):
+                # Left behind by a worker that died while building it
+                if mtime < time.time() - 3600:
+                    remove_path(pth)
+                continue
+            size = path_size(pth)
+        except OSError:
+            continue            # Removed by another worker
+        total += size
+        if pth != keep:
+            entries.append((mtime, size, pth))
+
+    entries.sort()
+    while entries and total > maxsize * 1024 * 1024:
+        mtime, size, pth = entries.pop(0)
+        if not evict_entry(pth): continue
+        LOGINFO("Evicted cached " + pth)
+        total -= size
+
 def get_remapped_mask(src_fn, mask_fn, remap_mask_fn='GS_omask.tiff'):
 
-    create_remapped_mask(src_fn, mask_fn, remap_mask_fn)
+    if mask_cachedir is None:
+        create_remapped_mask(src_fn, mask_fn, remap_mask_fn)
+
+        ms = gdal.Open(remap_mask_fn)
+        return ms
 
-    ms = gdal.Open(remap_mask_fn)
+    # Masks are written under a temporary name and renamed into place, so
+    # concurrent workers only ever see complete files.  The modification
+    # time of an entry is its last use, for LRU eviction.
+    mkdir_p(mask_cachedir)
+    cached_fn = os.path.join(mask_cachedir, mask_cache_key(src_fn, mask_fn) + '.tiff')
+    try:
+        os.utime(cached_fn, None)
+        ms = gdal.Open(cached_fn)
+        LOGINFO("Using cached mask " + cached_fn)
+        return ms
+    except (OSError, RuntimeError):
+        pass
+
+    fd, tmp_fn = tempfile.mkstemp(suffix='.tmp', dir=mask_cachedir)
+    os.close(fd)
+    try:
+        create_remapped_mask(src_fn, mask_fn, tmp_fn)
+        os.rename(tmp_fn, cached_fn)
+    except:
+        os.unlink(tmp_fn)
+        raise
+    LOGINFO("Cached mask " + cached_fn)
+    evict_lru(mask_cachedir, mask_cachesize, keep=cached_fn)
+
+    ms = gdal.Open(cached_fn)
     return ms
 
 
+class SceneCatalog(object):
+    '''The NDVI scenes of a tile, listed once.
+
+    scenes -- list of (year, dnum, filename) tuples, sorted by file name
+              and therefore by date
+    headers -- (path, geotransform, shape, data type) of every scene
+               opened so far, by file name
+
+    Scenes are listed from their names, and only opened when read, so that
+    scenes outside the dates of a product are never opened.  The header
+    of a scene is checked against the tile the first time it is read, see
+    check().'''
+
+    pattern = re.compile(r'ndvi(\d+)_(\d+).tiff')
+
+    def __init__(self, datadir):
+        self.datadir = datadir
+        self.headers = {}
+
+        cube = load_cube(datadir)
+        if cube is not None:
+            self.scenes = cube.scenes
+            return
+
+        self.scenes = []
+        for fn in sorted(load_members(datadir) or os.listdir(datadir)):
+            m = self.pattern.match(fn)
+            if not m: continue
+            year, dnum = map(int, m.groups())
+            self.scenes.append((year, dnum, fn))
+
+        if not self.scenes: raise RuntimeError('No input files found')
+
+    def select(self, years=None, days=None, dates=None):
+        return select_scenes(self.scenes, years, days, dates)
+
+    def check(self, fn, ds, tran, shape):
+        '''Check scene fn, opened as ds, against the geotransform and shape
+        of the tile, unless it was checked before.'''
+
+        if fn in self.headers: return
+        header = (scene_path(self.datadir, fn), ds.GetGeoTransform(),
+                  (ds.RasterYSize, ds.RasterXSize), ds.GetRasterBand(1).DataType)
+        # if ds.GetProjectionRef() != proj \
+        if header[1] != tran or header[2] != shape:
+            raise ValueError("Bogus file: " + header[0])
+        self.headers[fn] = header
+
+def within(value, limits):
+    first, last = limits
+    return (first is None or value >= first) and (last is None or value <= last)
+
+def select_scenes(scenes, years=None, days=None, dates=None):
+    '''Select scenes by date, from their names only.
+
+    scenes -- list of (year, dnum, filename) tuples
+    years -- first and last year, e.g. (2000, 2010)
+    days -- first and last day number within each year
+    dates -- first and last date within each year, as (month, day)
+
+    All limits are inclusive, and may be None.'''
+
+    selected = []
+    for scene in scenes:
+        year, dnum = scene[0] + 2000, scene[1]
+        if years is not None and not within(year, years): continue
+        if days is not None and not within(dnum, days): continue
+        if dates is not None:
+            date = dt.date(year, 1, 1) + dt.timedelta(dnum-1)
+            if not within((date.month, date.day), dates): continue
+        selected.append(scene)
+    return selected
+
+_catalogs = {}
+
+def scene_catalog(datadir):
+    if datadir not in _catalogs:
+        _catalogs[datadir] = SceneCatalog(datadir)
+    return _catalogs[datadir]
+
+def list_scenes(datadir):
+    '''List the NDVI scenes of a tile.
+
+    datadir -- directory containing input files
+
+    Returns a list of (year, dnum, filename) tuples, sorted by file name
+    and therefore by date.'''
+
+    return scene_catalog(datadir).scenes
+
+def tile_mask(datadir, scenes, outputdir):
+    # Use input data source as template to remap mask
+    with timed('mask'):
+        return get_remapped_mask(scene_path(datadir, scenes[0][2]),
+                                 os.path.join(permadir, mask_fname),
+                                 os.path.join(outputdir, 'GS_omask.tiff'))
+
+def window_pixel_bytes(itemsize, nsweep=1, nyears=1):
+    '''Estimated bytes held per pixel of a window.
+
+    The mask, the onset average and the onset thresholds are shared by the
+    years.  Each year computed at once, up to year_workers of them, holds
+    the scene being read, the arrays of its accumulators and the
+    temporaries of their kernels; the onset and end days, the end
+    thresholds and most temporaries have an entry per multiplier of a
+    sweep.
+
+    itemsize -- bytes per pixel of the scenes
+    nsweep -- number of threshold multipliers of a sweep, or 1
+    nyears -- number of years of the tile'''
+
+    shared = itemsize + 8 + 4 * nsweep
+    # Scene, last scene, peak day and data, end sum, mask copies; onset
+    # fill and end average as float64
+    year = 6 * itemsize + 16
+    # Onset and end thresholds as float64, end days, comparisons and
+    # np.where indices
+    year += nsweep * (8 + 8 + itemsize + 32)
+    return shared + min(year_workers, nyears) * year
+
+def row_windows(datadir, scenes, nsweep=1):
+    '''Split a tile into windows of rows within the memory budget.
+
+    nsweep -- the largest number of threshold multipliers of a sweep
+
+    Returns a list of (yoff, nrows), where nrows is a multiple of the block
+    height of the input files, except for the last window.'''
+
+    ds = gdal.Open(scene_path(datadir, scenes[0][2]), GA_ReadOnly)
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    if not memory_budget:
+        return [(0, ysize)]
+
+    band = ds.GetRasterBand(1)
+    bheight = band.GetBlockSize()[1]
+    itemsize = gdal.GetDataTypeSize(band.DataType) // 8
+    pixel_bytes = window_pixel_bytes(itemsize, nsweep, len(split_years(scenes)))
+    nrows = int(memory_budget * 1024 * 1024 / (xsize * pixel_bytes))
+    nrows = max(bheight, nrows - nrows % bheight)
+    windows = [(yoff, min(nrows, ysize - yoff)) for yoff in range(0, ysize, nrows)]
+    LOGINFO("Processing {0} rows in {1} windows of {2} rows".format(ysize, len(windows), nrows))
+    return windows
+
+def read_window(ds, window, band=None):
+    yoff, nrows = window
+    if band is not None:
+        return ds.GetRasterBand(band).ReadAsArray(0, yoff, ds.RasterXSize, nrows)
+    return ds.ReadAsArray(0, yoff, ds.RasterXSize, nrows)
+
+class LandPixels(object):
+    '''The land pixels of a window.
+
+    The kernels then work on vectors of the land pixels only: gather()
+    picks them from the rows of the window, and scatter() puts them back,
+    with fill elsewhere.  Leading axes, such as the thresholds of a sweep,
+    are kept.  mask is the mask of the window, and vmask the vector of the
+    mask of the land pixels, for the kernels.'''
+
+    def __init__(self, mask):
+        self.mask = mask
+        self.index = np.flatnonzero(mask == 1)
+        self.vmask = mask.reshape(-1)[self.index]
+        self.size = len(self.index)
+
+    def gather(self, data):
+        return data.reshape(data.shape[:-2] + (-1,))[..., self.index]
+
+    def scatter(self, values, fill):
+        data = np.empty(values.shape[:-1] + self.mask.shape, np.result_type(values, fill))
+        data[...] = fill
+        data.reshape(values.shape[:-1] + (-1,))[..., self.index] = values
+        return data
+
+def land_pixels(mask):
+    '''Compact the window of mask if it has little land, see compact_fraction.
+
+    Returns the mask for the kernels, and the LandPixels of the window or
+    None if the window is not compacted.'''
+
+    if np.count_nonzero(mask == 1) >= compact_fraction * mask.size:
+        return mask, None
+    land = LandPixels(mask)
+    return land.vmask, land
+
+def read_scene(datadir, fn, tran, shape, window, land=None):
+    '''Read the rows of window of scene fn.
+
+    With the LandPixels of the window, returns the vector of its land
+    pixels, and skips the file if there are none.'''
+
+    if land is not None and land.size == 0:
+        return None, np.zeros(0, land.vmask.dtype)
+
+    cube = load_cube(datadir)
+    if cube is not None:
+        # Checked against the tile when the cube was built
+        yoff, nrows = window
+        data = cube.data[cube.index[fn], yoff:yoff+nrows]
+        if land is not None: data = land.gather(data)
+        count(scene_reads=1, read_bytes=data.nbytes)
+        return None, data
+
+    with timed('read'):
+        ds = gdal.Open(scene_path(datadir, fn), GA_ReadOnly)
+        scene_catalog(datadir).check(fn, ds, tran, shape)
+        data = read_window(ds, window, scene_band(datadir, fn))
+    count(scene_reads=1, read_bytes=data.nbytes)
+    if land is not None: data = land.gather(data)
+    return ds, data
+
+class SceneCube(object):
+    '''The scenes of a tile, stacked in a read-only memory-mapped array of
+    shape (time, y, x).
+
+    The cube directory holds the array, an index of the scenes, and the
+    first scene as a GeoTIFF, which serves as template for the tile grid.'''
+
+    def __init__(self, cubedir):
+        index = json.load(open(os.path.join(cubedir, cube_index_fname)))
+        self.tile = index['tile']
+        self.scenes = [tuple(scene) for scene in index['scenes']]
+        self.index = dict((fn, i) for i, (year, dnum, fn) in enumerate(self.scenes))
+        self.data = np.load(os.path.join(cubedir, cube_fname), mmap_mode='r')
+
+_cubes = {}
+
+def load_cube(datadir):
+    '''Return the SceneCube in datadir, or None if it holds GeoTIFF files.'''
+
+    if datadir not in _cubes:
+        if os.path.exists(os.path.join(datadir, cube_index_fname)):
+            _cubes[datadir] = SceneCube(datadir)
+        else:
+            _cubes[datadir] = None
+    return _cubes[datadir]
+
+_members = {}
+
+def load_members(datadir):
+    '''Return the index of the scenes in the tarballs or stacks of the tile
+    in datadir, or None if the scenes were unpacked.'''
+
+    if datadir not in _members:
+        try:
+            fd = open(os.path.join(datadir, scene_index_fname))
+        except IOError:
+            _members[datadir] = None
+        else:
+            _members[datadir] = json.load(fd)
+            fd.close()
+    return _members[datadir]
+
+def scene_path(datadir, fn):
+    '''Path by which GDAL opens scene fn of the tile in datadir.'''
+
+    members = load_members(datadir)
+    if members is None:
+        return os.path.join(datadir, fn)
+    if isinstance(members[fn], list):
+        return str(members[fn][0])
+    return str(members[fn])
+
+def scene_band(datadir, fn):
+    '''Band of scene fn in its stack, or None if it is a file of its own.'''
+
+    members = load_members(datadir)
+    if members is None or not isinstance(members[fn], list):
+        return None
+    return members[fn][1]
+
+def stack_members(path):
+    '''Index the bands of the stack path by the names of their scenes, as
+    [path, band], from the FILE metadata written by sensyf-tile -stack.'''
+
+    ds = gdal.Open(path, GA_ReadOnly)
+    members = {}
+    for band in range(1, ds.RasterCount + 1):
+        fn = ds.GetRasterBand(band).GetMetadataItem('FILE')
+        if fn is None: raise ValueError("Bogus stack: " + path)
+        members[fn] = [os.path.abspath(path), band]
+    return members
+
+_cube_locks = {}
+
+def release_tile(datadir):
+    _cubes.pop(datadir, None)
+    _members.pop(datadir, None)
+    _catalogs.pop(datadir, None)
+    lock = _cube_locks.pop(datadir, None)
+    if lock is not None: lock.close()
+
+def build_cube(tiledir, cubedir, tile):
+    '''Stack the scenes in tiledir into a SceneCube in cubedir.
+
+    Scenes are stored as int16 if they are int16, and as float32 otherwise.
+    They are copied in the windows of rows of row_windows, so that no more
+    than a window of a scene is held in memory.  The cube is built under a
+    temporary name and renamed into place.'''
+
+    scenes = list_scenes(tiledir)
+    ds = gdal.Open(scene_path(tiledir, scenes[0][2]), GA_ReadOnly)
+    tran = ds.GetGeoTransform()
+    shape = (ds.RasterYSize, ds.RasterXSize)
+    dtype = ds.ReadAsArray(0, 0, 1, 1).dtype
+    if dtype != np.int16: dtype = np.float32
+
+    LOGINFO("Building cube of {0} scenes for tile {1}".format(len(scenes), tile))
+    tmpdir = tempfile.mkdtemp(suffix='.tmp', dir=os.path.dirname(cubedir))
+    try:
+        out = create_template(os.path.join(tmpdir, scenes[0][2]), ds)
+        out = None
+        data = np.lib.format.open_memmap(os.path.join(tmpdir, cube_fname), 'w+',
+                                         dtype, (len(scenes),) + shape)
+        for yoff, nrows in row_windows(tiledir, scenes):
+            for i, (year, dnum, fn) in enumerate(scenes):
+                junk, data[i, yoff:yoff+nrows] = read_scene(tiledir, fn, tran, shape, (yoff, nrows))
+        data.flush()
+        data = None
+        fd = open(os.path.join(tmpdir, cube_index_fname), 'w')
+        json.dump({'tile': tile, 'scenes': scenes}, fd)
+        fd.close()
+    except:
+        rmtree(tmpdir)
+        raise
+
+    try:
+        os.rename(tmpdir, cubedir)
+    except OSError:
+        rmtree(tmpdir)          # Built meanwhile by another worker
+
+def peak_average(datadir, scenes, mask_ds, mask, date_start, date_end, window, land=None):
+    '''Accumulate the average NDVI over the peak period.
+
+    datadir -- where input files are found
+    scenes -- list of scenes, as returned by list_scenes
+    mask_ds -- the remapped mask dataset
+    mask -- the remapped land mask within the window
+    date_start -- 
+    date_end -- date intervals to consider, see average()
+    window -- the rows to process, as (yoff, nrows)
+    land -- the LandPixels of the window if it is compacted, see land_pixels
+
+    Returns the average (NaN where masked or without data) and a
+    description of it.'''
+
+    acc = PeakAverage(mask, date_start, date_end, window[0])
+    run_seasons(datadir, scenes, mask_ds, [acc], window, land)
+    return acc.avg, acc.descr
+
+def save_average(ds, outputdir, avg_fname, avg, image_descr, yoff=0, land=None):
+    # Create file with average, or add a window to it
+    avg_fname = os.path.join(outputdir, avg_fname)
+    if land is not None: avg = land.scatter(avg, np.nan)
+    with timed('save', write_bytes=4*avg.size):
+        if yoff == 0:
+            out = gtiff_profiles.create(avg_fname, ds.RasterXSize, ds.RasterYSize,
+                                        GDT_Float32, output_profile)
+            out.SetGeoTransform(ds.GetGeoTransform())
+            out.SetProjection(ds.GetProjectionRef())
+            out.SetMetadataItem('TIFFTAG_IMAGEDESCRIPTION', image_descr)
+        else:
+            out = gdal.Open(avg_fname, GA_Update)
+        out.GetRasterBand(1).WriteArray(avg.astype(np.float32), 0, yoff)
+        out = None                # Close and flush file
+        if yoff + avg.shape[0] == ds.RasterYSize:
+            gtiff_profiles.finish(avg_fname, output_profile, yoff > 0, 'AVERAGE')
+
 def average(datadir, outputdir, avg_fname, date_start, date_end):
     '''Prototype functionality for averaging in SenSyF S2 Service.
 
@@ -156,91 +923,62 @@ def average(datadir, outputdir, avg_fname, date_start, date_end):
          will compute the average for the period July 4th to August 3rd 
          over all years from 2000 to 2010 (inclusive).'''
 
-    dts = time.strptime(date_start, '%Y-%m-%d')
-    dte = time.strptime(date_end, '%Y-%m-%d')
-    ys, ye = dts.tm_year, dte.tm_year
-    ms, me = dts.tm_mon,  dte.tm_mon
-    ds, de = dts.tm_mday, dte.tm_mday
-
-    pat = re.compile(r'^ndvi(\d+)_(\d+)')
-    for filename in os.listdir(datadir):
-        m = pat.search(filename)
-        if m: break
-
-    if not m: raise RuntimeError('No input files found')
+    scenes = list_scenes(datadir)
+    m_ds = tile_mask(datadir, scenes, outputdir)
 
-
-    # Use input data source as template to remap mask
-    m_ds = get_remapped_mask(os.path.join(datadir, filename),
-                             os.path.join(permadir, mask_fname))
-    mask = m_ds.ReadAsArray()
-    
-    ndat = np.zeros(mask.shape, dtype=np.int16)
-    data = np.zeros(mask.shape, dtype=np.float64)
-
-    inputs = []
-    ymin = ye
-    ymax = ys
-    for filename in os.listdir(datadir):
-        m = pat.search(filename)
-        if not m: continue
-        ynum, dnum = map(int, m.groups())
-        if ynum+2000 < ys or ynum+2000 > ye: continue
-        date = dt.date(ynum+2000, 1, 1) + dt.timedelta(dnum-1)
-        if date < dt.date(ynum+2000, ms, ds) or date > dt.date(ynum+2000, me, de): continue
-        inputs.append(filename)
-        ymin = min(ymin, ynum+2000)
-        ymax = max(ymax, ynum+2000)
-
-        dds = gdal.Open(os.path.join(datadir, filename))
-        ddd = dds.ReadAsArray()
-        xy = np.where(ddd > 0)
-        data[xy] += ddd[xy]
-        ndat[xy] += 1
-        LOGINFO("read file " + filename)
-
-    avg = np.where((mask == 1) & (ndat != 0), data/ndat, np.nan)
-    inputs.sort()
-
-    image_descr = """Average NDVI computed over {nfiles} files.
-The files span the years {ymin} to {ymax},
-and in each year the dates from {ms:02}-{ds:02} to {me:02}-{de:02} (MM-DD).
-
-File names:
-  {flist}""".format(nfiles=len(inputs), ymin=ymin, ymax=ymax,
-        ms=ms, ds=ds, me=me, de=de, flist="\n  ".join(inputs))
-
-    # Create file with average
-    ysize, xsize = avg.shape
-    driver = gdal.GetDriverByName('GTiff')
-    out = driver.Create(os.path.join(outputdir, avg_fname), xsize, ysize, 1, GDT_Float32)
-    out.SetGeoTransform(dds.GetGeoTransform())
-    out.SetProjection(dds.GetProjectionRef())
-    out.SetMetadataItem('TIFFTAG_IMAGEDESCRIPTION', image_descr)
-    out.GetRasterBand(1).WriteArray(avg.astype(np.float32))
-    out = None                # Close and flush file
+    for window in row_windows(datadir, scenes):
+        mask, land = land_pixels(read_window(m_ds, window))
+        avg, image_descr = peak_average(datadir, scenes, m_ds, mask,
+                                        date_start, date_end, window, land)
+        save_average(m_ds, outputdir, avg_fname, avg, image_descr, window[0], land)
     return 0
 
-def save_product(ds, outputdir, data, year, mask, fmt, prod_name, prod_description):
-    ysize, xsize = data.shape
+def save_product(ds, outputdir, data, year, mask, fmt, prod_name, prod_description, yoff=0, land=None,
+                 band_names=None):
+    '''Save a product, or the window of it starting at row yoff.  The file
+    is created when the first window is saved, with the size of ds.  With
+    the LandPixels of a compacted window, data and mask are vectors of its
+    land pixels, and are scattered back into the window.  The products of
+    a threshold sweep have a first axis of one band per threshold, named
+    in band_names.'''
+
+    ysize, xsize = ds.RasterYSize, ds.RasterXSize
 
     driver = gdal.GetDriverByName(fmt)
     if fmt == 'GTiff': prod_name += '.tiff'
     elif fmt == 'ENVI': prod_name += '.dat'
     else: raise RuntimeError('Format ' + fmt + ' to be added')
-    out = driver.Create(prod_name, xsize, ysize, 1, GDT_Byte)
 
-    if mask is not None:
-        data = np.where(mask == 1, data, mask)
-
-    out.SetGeoTransform(ds.GetGeoTransform())
-    out.SetProjection(ds.GetProjectionRef())
-    out.SetMetadataItem('TIFFTAG_IMAGEDESCRIPTION', prod_description)
-    # out.SetMetadataItem('band_names', prod_description)
-    rb = out.GetRasterBand(1)
-    # rb.SetDescription(prod_description)
-    rb.WriteArray(encode(data))
-    out = None                  # Close and flush file
+    with timed('save'):
+        if land is not None:
+            data, mask = land.scatter(data, land.mask), land.mask
+        if mask is not None:
+            data = np.where(mask == 1, data, mask)
+        count(write_bytes=data.size)
+        bands = encode(data).reshape((-1,) + data.shape[-2:])
+
+        if yoff == 0:
+            if fmt == 'GTiff':
+                out = gtiff_profiles.create(prod_name, xsize, ysize, GDT_Byte, output_profile,
+                                            len(bands))
+            else:
+                out = driver.Create(prod_name, xsize, ysize, len(bands), GDT_Byte)
+            out.SetGeoTransform(ds.GetGeoTransform())
+            out.SetProjection(ds.GetProjectionRef())
+            out.SetMetadataItem('TIFFTAG_IMAGEDESCRIPTION', prod_description)
+            # out.SetMetadataItem('band_names', prod_description)
+            for i, name in enumerate(band_names or []):
+                out.GetRasterBand(i + 1).SetDescription(name)
+        else:
+            out = gdal.Open(prod_name, GA_Update)
+        for i, band in enumerate(bands):
+            rb = out.GetRasterBand(i + 1)
+            # rb.SetDescription(prod_description)
+            rb.WriteArray(band, 0, yoff)
+            rb = None
+        out = None                  # Close and flush file
+        if fmt == 'GTiff' and yoff + data.shape[-2] == ysize:
+            gtiff_profiles.finish(prod_name, output_profile, yoff > 0)
 
     # ff = file(prod_name + '.dat', 'w')
     # ff.write(data)
@@ -250,21 +988,24 @@ def save_product(ds, outputdir, data, year, mask, fmt, prod_name, prod_descripti
     # hdr['band names'] = ['Growth season onset']
 
     # dh.writeHdr(prod_name + '.hdr', hdr)
-    LOGINFO("wrote " + prod_name)
+    if yoff + data.shape[-2] == ysize:
+        LOGINFO("wrote " + prod_name)
 
-def save_onset(ds, outputdir, onset, year, mask=None, fmt='GTiff', description=''):
+def save_onset(ds, outputdir, onset, year, mask=None, fmt='GTiff', description='', yoff=0, land=None,
+               band_names=None):
     GSO_name = os.path.join(outputdir, 'GS_onset_{0}'.format(2000+year))
-    save_product(ds, outputdir, onset, year, mask, fmt, GSO_name, description)
+    save_product(ds, outputdir, onset, year, mask, fmt, GSO_name, description, yoff, land, band_names)
 
-def save_peak(ds, outputdir, peak, year, mask=None, fmt='GTiff', description=''):
+def save_peak(ds, outputdir, peak, year, mask=None, fmt='GTiff', description='', yoff=0, land=None):
     GSP_name = os.path.join(outputdir, 'GS_peak_{0}'.format(2000+year))
-    save_product(ds, outputdir, peak, year, mask, fmt, GSP_name, description)
+    save_product(ds, outputdir, peak, year, mask, fmt, GSP_name, description, yoff, land)
 
-def save_end(ds, outputdir, end, year, mask=None, fmt='GTiff', description=''):
+def save_end(ds, outputdir, end, year, mask=None, fmt='GTiff', description='', yoff=0, land=None,
+             band_names=None):
     GSE_name = os.path.join(outputdir, 'GS_end_{0}'.format(2000+year))
-    save_product(ds, outputdir, end, year, mask, fmt, GSE_name, description)
+    save_product(ds, outputdir, end, year, mask, fmt, GSE_name, description, yoff, land, band_names)
 
-def GS_avgpeak(avg_fname):
+def GS_avgpeak(avg_fname, window=None):
 
     gdal.UseExceptions()
     # avg_fname = 'peak_average.tiff'
@@ -272,198 +1013,516 @@ def GS_avgpeak(avg_fname):
       # hdr, avg = dh.read_envi(avg_fname)
       # junk = open(avg_fname, 'r')   # To provoke IOError
       ds = gdal.Open(avg_fname, GA_ReadOnly)
-      avg = ds.ReadAsArray()
+      avg = ds.ReadAsArray() if window is None else read_window(ds, window)
     except:
       return None, None
 
     return ds, avg
 
-def above(datadir, outputdir, thr_scale, avg_fname):
-    '''Prototype functionality for finding first day above a threshold in SenSyF S2 Service.
-
-    datadir -- directory containing input files
-    outputdir -- directory wherein to place the result files
-    thr_scale -- the scaling of the average which constitutes the threshold
-    avg_fname -- name of file (in permadir) where results (average) has been saved. '''
-
-    pat = re.compile(r'ndvi(\d+)_(\d+).tiff')
-
-    files_used = []
-    for filename in os.listdir(datadir):
-        m = pat.search(filename)
-        if m: break
-
-    if not m: raise RuntimeError('No input files found')
-
-    # Use input data source as template to remap mask
-    mask_ds = get_remapped_mask(os.path.join(datadir, filename),
-                                os.path.join(permadir, mask_fname))
-    mask = mask_ds.ReadAsArray()
-    proj = mask_ds.GetProjectionRef()
-    tran = mask_ds.GetGeoTransform()
-
-    # hdr, avg_peak = GS_avgpeak(datadir)
-    ds, avg_peak = GS_avgpeak(os.path.join(outputdir, avg_fname))
-
-    avg_descr = ds.GetMetadataItem('TIFFTAG_IMAGEDESCRIPTION')
-    LOGINFO("Got avg_peak with shape {0} and dtype {1}".format(avg_peak.shape, avg_peak.dtype))
-    thr = thr_scale * avg_peak
 
-    if ds.GetGeoTransform() != tran \
-       or avg_peak.shape != mask.shape:
-            raise ValueError, "Bogus file: " + avg_fname
-
-    files = sorted([ x for x in os.listdir(datadir) if pat.match(x) ])
-
-    lastyear = -1
-    onset = None
-    # oset = []
-    filelist = []
-    for fn in files:
-        try:
-            year, dnum = map(int, pat.match(fn).groups())
-        except:
-            print "File {} not understood".format(fn)
-            bah()
-            continue
+# A threshold sweep computes the onset or end products for several threshold
+# multipliers in the same pass over the scenes.  The multipliers are then a
+# list rather than a number, the thresholds and products get a first axis
+# of one entry per multiplier, and the products are saved with one band
+# per multiplier.
+
+def thresholds(value):
+    '''Threshold multiplier(s) of a parameter: one number, or a list for a
+    sweep from several numbers separated by commas.'''
+
+    scales = [float(x) for x in str(value).split(',')]
+    return scales if len(scales) > 1 else scales[0]
+
+def is_sweep(thr_scale):
+    return isinstance(thr_scale, (list, tuple))
+
+def sweep_len(thr_scale):
+    return len(thr_scale) if is_sweep(thr_scale) else 1
+
+def scale_threshold(thr_scale, avg):
+    '''Thresholds thr_scale times avg, stacked for a sweep.'''
+
+    if is_sweep(thr_scale):
+        return np.array([scale * avg for scale in thr_scale])
+    return thr_scale * avg
+
+def sweep_array(a, thr_scale):
+    '''a, or copies of a stacked for each multiplier of a sweep.'''
+
+    if not is_sweep(thr_scale): return a
+    out = np.empty((len(thr_scale),) + a.shape, a.dtype)
+    out[...] = a
+    return out
+
+def threshold_text(thr_scale):
+    if not is_sweep(thr_scale): return str(thr_scale)
+    return ', '.join(str(scale) for scale in thr_scale) + ' (one band each)'
+
+def threshold_names(thr_scale):
+    if not is_sweep(thr_scale): return None
+    return ['threshold {0}'.format(scale) for scale in thr_scale]
+
+# Accumulators for the growing season products of one year.  The scenes of
+# the year are fed to them in date order through run_seasons(): visit() is
+# called for every scene and tells whether the data is needed, update()
+# then folds the data into the state of the year, and close() saves the
+# product.  The mask and threshold arrays are only read, so accumulators
+# for different years may share them and run concurrently.  In a compacted
+# window, see land_pixels, the mask, threshold and data are vectors of the
+# land pixels, and the LandPixels of the window are passed on to the save
+# functions, which scatter the products back.  The attributes
+# named in state_arrays and state_scalars make up the state of the year,
+# which may be checkpointed with save_state() and restored with load_state();
+# restored is then set.  PeakAverage is an accumulator of the same kind over
+# the scenes of all years, whose close() only finishes the average.
+
+class PeakAverage(object):
+    '''Average NDVI over the peak period, from the sums of the positive
+    values of the scenes and their number.  close() sets avg, NaN where
+    masked or without data, and its description descr.'''
+
+    state_arrays = ('data', 'ndat')
+    state_scalars = ('inputs', 'ymin', 'ymax')
+    restored = False
+
+    def __init__(self, mask, date_start, date_end, yoff=0):
+        dts = time.strptime(date_start, '%Y-%m-%d')
+        dte = time.strptime(date_end, '%Y-%m-%d')
+        self.years = (dts.tm_year, dte.tm_year)
+        self.dates = ((dts.tm_mon, dts.tm_mday), (dte.tm_mon, dte.tm_mday))
+
+        self.yoff = yoff
+        self.mask = mask
+        self.ndat = np.zeros(mask.shape, dtype=np.int16)
+        self.data = np.zeros(mask.shape, dtype=np.float64)
+        self.inputs = []
+        self.ymin = dte.tm_year
+        self.ymax = dts.tm_year
+        self.year = None
+
+    def visit(self, year, dnum):
+        self.year = year
+        return bool(select_scenes([(year, dnum, None)], self.years, dates=self.dates))
+
+    def update(self, dnum, fn, data):
+        self.inputs.append(fn)
+        self.ymin = min(self.ymin, self.year+2000)
+        self.ymax = max(self.ymax, self.year+2000)
+        xy = np.where(data > 0)
+        self.data[xy] += data[xy]
+        self.ndat[xy] += 1
+        if self.yoff == 0: LOGINFO("read file " + fn)
+
+    def close(self):
+        if not self.inputs: raise RuntimeError('No input files in the peak period')
+        self.inputs.sort()      # Also those folded into a checkpoint later
+        self.avg = np.where((self.mask == 1) & (self.ndat != 0), self.data/self.ndat, np.nan)
+
+        (ms, ds), (me, de) = self.dates
+        self.descr = """Average NDVI computed over {nfiles} files.
+The files span the years {ymin} to {ymax},
+and in each year the dates from {ms:02}-{ds:02} to {me:02}-{de:02} (MM-DD).
 
-        if year != lastyear:
-            if onset is not None:
-                # save data
-                GSO_description = """Arctic/Alpine Growing Season Onset.
-Computed for the year {year}, using {nfiles} files.
-The growing season onset is defined as the day when the daily NDVI value
-exceeds {thr} times an average over the peak period.
-Files:\n  {fn}""".format(year=2000+year, nfiles=len(filelist),
-                fn="\n  ".join(filelist), thr=thr_scale)
-                save_onset(ds, outputdir, onset, lastyear, mask=mask,
-                    description=GSO_description + '\n\n' + avg_descr)
-                # oset.append(onset)
-                filelist = []
-
-            # onset = np.zeros(data.shape) + np.nan
-            lastdata = None
-
-        # Here, lastdata does not exist if this is first data set in the year
-        lastyear = year
-
-        # hdr, data = dh.read_envi(datadir + fn)
-        ds = gdal.Open(os.path.join(datadir, fn), GA_ReadOnly)
-        data = ds.ReadAsArray()
-        filelist.append(fn)
-        # if ds.GetProjectionRef() != proj \
-        if ds.GetGeoTransform() != tran \
-           or data.shape != mask.shape:
-                raise ValueError, "Bogus file: " + os.path.join(datadir, fn)
-        # print "Read file " + fn
-        if lastdata is None:
+File names:
+  {flist}""".format(nfiles=len(self.inputs), ymin=self.ymin, ymax=self.ymax,
+        ms=ms, ds=ds, me=me, de=de, flist="\n  ".join(self.inputs))
+
+class OnsetSeason(object):
+    '''First day above a threshold, interpolated between scenes.'''
+
+    state_arrays = ('onset', 'lastdata')
+    state_scalars = ('year', 'lastday', 'filelist')
+    restored = False
+
+    def __init__(self, ds, outputdir, mask, thr, thr_scale, avg_descr, yoff=0, land=None):
+        self.ds = ds
+        self.yoff = yoff
+        self.land = land
+        self.outputdir = outputdir
+        self.mask = mask
+        self.thr = thr
+        self.thr_scale = thr_scale
+        self.avg_descr = avg_descr
+        self.year = None
+        self.onset = None
+        self.lastdata = None
+        self.filelist = []
+
+    def visit(self, year, dnum):
+        self.year = year
+        return True
+
+    def update(self, dnum, fn, data):
+        mask, thr = self.mask, self.thr
+        self.filelist.append(fn)
+        if self.lastdata is None:
             # First dataset of year
-            # onset[np.where(data > thr)] = dnum
-            onset = np.where(mask == 1, np.nan, mask)
-            onset = np.where(np.isnan(onset) & (data > thr), dnum, onset)
+            onset = sweep_array(np.where(mask == 1, np.nan, mask), self.thr_scale)
+            self.onset = np.where(np.isnan(onset) & (data > thr), dnum, onset)
         else:
+            onset = self.onset
             xy = np.where((data > thr) & np.isnan(onset))
             if len(xy[0]) != 0:
-                y0 = lastdata[xy]
-                y1 = data[xy]
-                dx = dnum - lastday
-                onset[xy] = lastday + dx*((thr[xy]-y0)/(y1-y0))
-        lastday = dnum
-        lastdata = data
-
-    # Done
-    GSO_description = """Growth season onset for the year {year},
-computed using {nfiles} files.
+                pix = xy[-data.ndim:]   # Without the threshold axis of a sweep
+                y0 = self.lastdata[pix]
+                y1 = data[pix]
+                dx = dnum - self.lastday
+                onset[xy] = self.lastday + dx*((thr[xy]-y0)/(y1-y0))
+        self.lastday = dnum
+        self.lastdata = data
+
+    def close(self):
+        if self.onset is None: return
+        GSO_description = """Arctic/Alpine Growing Season Onset.
+Computed for the year {year}, using {nfiles} files.
 The growing season onset is defined as the day when the daily NDVI value
 exceeds {thr} times an average over the peak period.
-Files:\n  {fn}""".format(year=2000+year, nfiles=len(filelist),
-                    fn="\n  ".join(filelist), thr=thr_scale)
-    save_onset(ds, outputdir, onset, year, mask=mask,
-               description=GSO_description + '\n\n' + avg_descr)
+Files:\n  {fn}""".format(year=2000+self.year, nfiles=len(self.filelist),
+                fn="\n  ".join(self.filelist), thr=threshold_text(self.thr_scale))
+        save_onset(self.ds, self.outputdir, self.onset, self.year, mask=self.mask,
+                   description=GSO_description + '\n\n' + self.avg_descr, yoff=self.yoff,
+                   land=self.land, band_names=threshold_names(self.thr_scale))
+
+class PeakSeason(object):
+    '''Day of highest NDVI value.'''
+
+    state_arrays = ('peak', 'peakdata')
+    state_scalars = ('year', 'filelist')
+    restored = False
+
+    def __init__(self, ds, outputdir, mask, yoff=0, land=None):
+        self.ds = ds
+        self.yoff = yoff
+        self.land = land
+        self.outputdir = outputdir
+        self.mask = mask
+        self.year = None
+        self.peak = None
+        self.peakdata = None
+        self.filelist = []
+
+    def visit(self, year, dnum):
+        self.year = year
+        return True
+
+    def update(self, dnum, fn, data):
+        mask = self.mask
+        self.filelist.append(fn)
+        if self.peakdata is None:
+            # First dataset of year
+            self.peak = np.where(mask == 1, dnum, mask)
+            self.peakdata = data.copy()
+        else:
+            xy = np.where((data > self.peakdata) & (mask == 1))
+            if len(xy[0]) != 0:
+                # TODO: fit a parabola
+                self.peakdata[xy] = data[xy]
+                self.peak[xy] = dnum
 
-    return 0
+    def close(self):
+        if self.peak is None: return
+        GSP_description = """Arctic/Alpine Growing Season Peak.
+Computed for the year {year}, using {nfiles} files.
+The growing season peak is simply the day when the daily NDVI attains its maximum value
+over the entire growing season.
+Files:\n  {fn}""".format(year=2000+self.year, nfiles=len(self.filelist), fn="\n  ".join(self.filelist))
+        save_peak(self.ds, self.outputdir, self.peak, self.year, mask=self.mask,
+                  description=GSP_description, yoff=self.yoff, land=self.land)
+
+class EndSeason(object):
+    '''First day below a threshold after the peak period.'''
+
+    state_arrays = ('peak_sum', 'gs_end', 'peak_average')
+    state_scalars = ('year', 'nsets', 'averaging', 'filelist')
+    restored = False
+
+    def __init__(self, ds, outputdir, mask, thr_scale, date_start, date_end, yoff=0, land=None):
+        dts = time.strptime(date_start, '%Y-%m-%d')
+        dte = time.strptime(date_end, '%Y-%m-%d')
+        self.ys, self.ye = dts.tm_year, dte.tm_year
+        self.ms, self.me = dts.tm_mon,  dte.tm_mon
+        self.ds_, self.de = dts.tm_mday, dte.tm_mday
+        self.dstart, self.dend = dts.tm_yday, dte.tm_yday
+
+        self.ds = ds
+        self.yoff = yoff
+        self.land = land
+        self.outputdir = outputdir
+        self.mask = mask
+        self.thr_scale = thr_scale
+        self.year = None
+        self.gs_end = None
+        self.filelist = []
+
+    def visit(self, year, dnum):
+        if year+2000 < self.ys or year+2000 > self.ye: return False
+
+        if self.gs_end is None:
+            self.peak_sum = 0 * self.mask
+            self.nsets = 0
+            self.gs_end = sweep_array(self.mask.copy(), self.thr_scale)
+            self.year = year
+            self.averaging = 1
+
+        return dnum >= self.dstart
+
+    def update(self, dnum, fn, data):
+        self.filelist.append(fn)
+
+        if self.averaging:
+            if dnum <= self.dend:
+                self.peak_sum += data
+                self.nsets += 1
+                return
+            else:
+                if self.nsets == 0: raise RuntimeError('No data in year')
+                self.peak_average = np.where(self.peak_sum > 0, self.peak_sum / self.nsets, 0)
+                self.gs_end[..., self.peak_average == 0] = 390       # No data
+                self.averaging = 0
+
+        thr = scale_threshold(self.thr_scale, self.peak_average)
+        ii = np.where((self.gs_end == 1) & (data < thr))
+        self.gs_end[ii] = dnum
+
+    def close(self):
+        if self.gs_end is None: return
+        GSE_description = """Arctic/Alpine Growing Season End.
+Computed for the year {year}, using {nfiles} files.
+The growing season has its peak period between the dates {ms:02}-{ds:02} and {me:02}-{de:02} (MM-DD),
+and is defined to end when the daily NDVI value sinks below {thr} times the average over the peak period.
+Files:\n  {fn}""".format(year=2000+self.year, nfiles=len(self.filelist), fn="\n  ".join(self.filelist),
+                thr=threshold_text(self.thr_scale), ms=self.ms, ds=self.ds_, me=self.me, de=self.de)
+        save_end(self.ds, self.outputdir, self.gs_end, self.year, mask=self.mask,
+                 description=GSE_description, yoff=self.yoff, land=self.land,
+                 band_names=threshold_names(self.thr_scale))
 
-def peak(datadir, outputdir):
-    '''Prototype functionality for finding day of highest value in SenSyF S2 Service.
+def run_seasons(datadir, scenes, mask_ds, seasons, window, land=None, folded=()):
+    '''Stream the scenes of one year, in date order, through a list of
+    season accumulators.
 
     datadir -- directory containing input files
-    outputdir -- directory wherein to place the result files.'''
+    scenes -- list of scenes of the year, as returned by list_scenes
+    mask_ds -- the remapped mask dataset, used as template for the products
+    seasons -- list of OnsetSeason, PeakSeason and EndSeason objects
+    window -- the rows to process, as (yoff, nrows)
+    land -- the LandPixels of the window if it is compacted, see land_pixels
+    folded -- names of the scenes in the checkpoint the accumulators were
+              restored from, which only those not restored are fed'''
 
-    pat = re.compile(r'ndvi(\d+)_(\d+).tiff')
+    tran = mask_ds.GetGeoTransform()
+    shape = (mask_ds.RasterYSize, mask_ds.RasterXSize)
+
+    for year, dnum, fn in scenes:
+        wanted = [s for s in seasons
+                  if not (s.restored and fn in folded) and s.visit(year, dnum)]
+        if not wanted: continue
+
+        ds, data = read_scene(datadir, fn, tran, shape, window, land)
+        with timed('compute'):
+            for s in wanted:
+                s.update(dnum, fn, data)
+
+    for s in seasons:
+        s.close()
+
+def split_years(scenes):
+    years = []
+    for scene in scenes:
+        if not years or years[-1][0][0] != scene[0]:
+            years.append([])
+        years[-1].append(scene)
+    return years
+
+def state_path(yeardir, season, attr):
+    return os.path.join(yeardir, '{0}.{1}.npy'.format(type(season).__name__, attr))
+
+def load_state(yeardir, seasons, window, land=None, fresh=()):
+    '''Restore the accumulators of a year from its checkpoint, except those
+    of the types in fresh, and set their restored.  The arrays of a
+    compacted window are gathered into vectors of its land pixels.
+
+    Returns the scenes folded into the checkpoint, as (year, dnum,
+    filename) tuples, or None if there is no checkpoint for the year.'''
+
+    olddir = yeardir + '.old'
+    if not os.path.exists(yeardir) and os.path.exists(olddir):
+        # Interrupted while replacing the checkpoint, see save_state
+        os.rename(olddir, yeardir)
+    try:
+        with open(os.path.join(yeardir, 'state.json')) as f:
+            index = json.load(f)
+    except IOError:
+        return None
+    if 'scenes' not in index:
+        return None             # Written before the scenes were listed
+
+    yoff, nrows = window
+    for season in seasons:
+        if isinstance(season, fresh): continue
+        season.restored = True
+        for attr, val in index[type(season).__name__].items():
+            setattr(season, str(attr), val)
+        for attr in season.state_arrays:
+            pth = state_path(yeardir, season, attr)
+            if not os.path.exists(pth): continue
+            data = np.load(pth, mmap_mode='r')
+            rows = np.array(data[..., yoff:yoff+nrows, :])
+            data = None
+            if land is not None: rows = land.gather(rows)
+            setattr(season, attr, rows)
+    return [tuple(scene) for scene in index['scenes']]
+
+def save_state(yeardir, seasons, window, shape, scenes, land=None):
+    '''Checkpoint the accumulators of a year.
+
+    The arrays of the window are written into a new checkpoint, which
+    replaces the previous one once the last window of the tile is written.
+
+    yeardir -- checkpoint directory of the year
+    seasons -- accumulators
+    window -- (yoff, nrows) of the rows held by the accumulators
+    shape -- shape of the tile
+    scenes -- the scenes folded in, as returned by list_scenes
+    land -- the LandPixels of the window if it is compacted.  Arrays are
+            then scattered back with zeros elsewhere, which the kernels
+            ignore as the mask is not 1 there.'''
+
+    yoff, nrows = window
+    newdir = yeardir + '.new'
+    if yoff == 0:
+        if os.path.exists(newdir): rmtree(newdir)
+        mkdir_p(newdir)
+
+    index = {'scenes': scenes}
+    for season in seasons:
+        index[type(season).__name__] = dict(
+            (attr, getattr(season, attr, None)) for attr in season.state_scalars)
+        for attr in season.state_arrays:
+            data = getattr(season, attr, None)
+            if data is None: continue
+            if land is not None: data = land.scatter(data, 0)
+            pth = state_path(newdir, season, attr)
+            if yoff == 0:
+                out = np.lib.format.open_memmap(pth, mode='w+', dtype=data.dtype,
+                                                shape=data.shape[:-2] + shape)
+            else:
+                out = np.load(pth, mmap_mode='r+')
+            out[..., yoff:yoff+nrows, :] = data
+            out.flush()
+            out = None
+
+    if yoff + nrows < shape[0]: return
+    with open(os.path.join(newdir, 'state.json'), 'w') as f:
+        json.dump(index, f)
+
+    olddir = yeardir + '.old'
+    if os.path.exists(yeardir): os.rename(yeardir, olddir)
+    os.rename(newdir, yeardir)
+    if os.path.exists(olddir): rmtree(olddir)
+
+def run_years(datadir, scenes, mask_ds, make_seasons, window, statedir=None, land=None,
+              fresh=()):
+    '''Run the season accumulators of every year of scenes, using up to
+    year_workers threads.
+
+    With a checkpoint directory the accumulators of each year start from
+    the checkpoint of the year, only the scenes not in the checkpoint are
+    folded in, and years without such scenes are left alone.  A year with
+    a new scene older than the last one in its checkpoint is computed
+    again from all its scenes, as the accumulators take the scenes in
+    date order.  The updated checkpoints are saved.
+
+    make_seasons -- function returning a fresh list of accumulators
+    statedir -- checkpoint directory of the tile, or None
+    fresh -- types of the accumulators which are not restored from the
+             checkpoints, but computed again from all scenes of every year
+    Other arguments as for run_seasons.'''
+
+    years = split_years(scenes)
+    shape = (mask_ds.RasterYSize, mask_ds.RasterXSize)
+
+    def run(year_scenes):
+        seasons = make_seasons()
+        if statedir is None:
+            run_seasons(datadir, year_scenes, mask_ds, seasons, window, land)
+            return
+
+        year = year_scenes[0][0]
+        yeardir = os.path.join(statedir, str(year))
+        folded = load_state(yeardir, seasons, window, land, fresh)
+        names = ()
+        if folded is not None:
+            names = set(scene[2] for scene in folded)
+            new = [scene for scene in year_scenes if scene[2] not in names]
+            if new and new[0][1] <= max(scene[1] for scene in folded):
+                if window[0] == 0:
+                    LOGINFO("Recomputing {0} for scenes older than its checkpoint".format(2000+year))
+                seasons, names = make_seasons(), ()
+            elif not new and all(s.restored for s in seasons):
+                if window[0] == 0: LOGINFO("No new scenes for {0}".format(2000+year))
+                return
+        run_seasons(datadir, year_scenes, mask_ds, seasons, window, land, names)
+        save_state(yeardir, seasons, window, shape, year_scenes, land)
+
+    if year_workers > 1 and len(years) > 1:
+        # Numpy and GDAL release the GIL, and threads share the mask and
+        # threshold arrays without copying them
+        pool = ThreadPool(min(year_workers, len(years)))
+        try:
+            pool.map(run, years)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for year_scenes in years:
+            run(year_scenes)
 
-    for filename in os.listdir(datadir):
-        m = pat.search(filename)
-        if m: break
+def above(datadir, outputdir, thr_scale, avg_fname):
+    '''Prototype functionality for finding first day above a threshold in SenSyF S2 Service.
 
-    if not m: raise RuntimeError('No input files found')
+    datadir -- directory containing input files
+    outputdir -- directory wherein to place the result files
+    thr_scale -- the scaling of the average which constitutes the threshold,
+         or a list of them for a threshold sweep
+    avg_fname -- name of file (in permadir) where results (average) has been saved. '''
 
-    # Use input data source as template to remap mask
-    mask_ds = get_remapped_mask(os.path.join(datadir, filename),
-                                os.path.join(permadir, mask_fname))
-    mask = mask_ds.ReadAsArray()
-    proj = mask_ds.GetProjectionRef()
-    tran = mask_ds.GetGeoTransform()
+    scenes = list_scenes(datadir)
+    mask_ds = tile_mask(datadir, scenes, outputdir)
 
-    files = sorted([ x for x in os.listdir(datadir) if pat.match(x) ])
+    for window in row_windows(datadir, scenes, sweep_len(thr_scale)):
+        mask, land = land_pixels(read_window(mask_ds, window))
 
-    lastyear = -1
-    peak = None
-    # pk = []
-    filelist = []
-    for fn in files:
-        try:
-            year, dnum = map(int, pat.match(fn).groups())
-        except:
-            print "File {} not understood".format(fn)
-            bah()
-            continue
+        # hdr, avg_peak = GS_avgpeak(datadir)
+        ds, avg_peak = GS_avgpeak(os.path.join(outputdir, avg_fname), window)
 
-        if year != lastyear:
-            if peak is not None:
-                # save data
-                GSP_description = """Arctic/Alpine Growing Season Peak.
-Computed for the year {year}, using {nfiles} files.
-The growing season peak is simply the day when the daily NDVI attains its maximum value
-over the entire growing season.
-Files:\n  {fn}""".format(year=2000+year, nfiles=len(filelist), fn="\n  ".join(filelist))
-                save_peak(ds, outputdir, peak, lastyear, mask=mask, description=GSP_description)
-                # pk.append(peak)
-                filelist = []
+        avg_descr = ds.GetMetadataItem('TIFFTAG_IMAGEDESCRIPTION')
+        LOGINFO("Got avg_peak with shape {0} and dtype {1}".format(avg_peak.shape, avg_peak.dtype))
 
-            # peak = np.zeros(data.shape) + np.nan
-            peakdata = None
+        if ds.GetGeoTransform() != mask_ds.GetGeoTransform() \
+           or avg_peak.shape != (window[1], mask_ds.RasterXSize):
+                raise ValueError("Bogus file: " + avg_fname)
+        if land is not None: avg_peak = land.gather(avg_peak)
+        thr = scale_threshold(thr_scale, avg_peak)
 
-        # Here, lastdata does not exist if this is first data set in the year
-        lastyear = year
-        filelist.append(fn)
+        run_years(datadir, scenes, mask_ds,
+                  lambda: [OnsetSeason(mask_ds, outputdir, mask, thr, thr_scale, avg_descr,
+                                       yoff=window[0], land=land)], window, land=land)
+    return 0
 
-        # hdr, data = dh.read_envi(datadir + fn)
-        ds = gdal.Open(os.path.join(datadir, fn), GA_ReadOnly)
-        data = ds.ReadAsArray()
-        # if ds.GetProjectionRef() != proj \
-        if ds.GetGeoTransform() != tran \
-           or data.shape != mask.shape:
-                raise ValueError, "Bogus file: peak_average.tiff"
-        # print "Read file " + fn
-        if peakdata is None:
-            # First dataset of year
-            peak = np.where(mask == 1, dnum, mask)
-            peakdata = data
-        else:
-            xy = np.where((data > peakdata) & (mask == 1))
-            if len(xy[0]) != 0:
-                # TODO: fit a parabola
-                peakdata[xy] = data[xy]
-                peak[xy] = dnum
-        # lastday = dnum
-        # lastdata = data
+def peak(datadir, outputdir):
+    '''Prototype functionality for finding day of highest value in SenSyF S2 Service.
+
+    datadir -- directory containing input files
+    outputdir -- directory wherein to place the result files.'''
 
-    # Done
-    GSP_description = """Growth season peak for the year {year},
-computed using {nfiles} files.
-Files:\n  {fn}""".format(year=2000+year, nfiles=len(filelist), fn="\n  ".join(filelist))
-    save_peak(ds, outputdir, peak, year, mask=mask, description=GSP_description)
+    scenes = list_scenes(datadir)
+    mask_ds = tile_mask(datadir, scenes, outputdir)
 
+    for window in row_windows(datadir, scenes):
+        mask, land = land_pixels(read_window(mask_ds, window))
+        run_years(datadir, scenes, mask_ds,
+                  lambda: [PeakSeason(mask_ds, outputdir, mask, yoff=window[0], land=land)],
+                  window, land=land)
     return 0
 
 def below(datadir, outputdir, thr_scale, date_start, date_end):
@@ -472,7 +1531,8 @@ def below(datadir, outputdir, thr_scale, date_start, date_end):
 
     datadir -- directory containing input files
     outputdir -- directory wherein to place the result files
-    thr_scale -- the scaling of the average which constitutes the threshold
+    thr_scale -- the scaling of the average which constitutes the threshold,
+         or a list of them for a threshold sweep
     date_start -- 
     date_end -- date intervals to consider.  The day/month ranges are
          considered separately within each year, i.e.
@@ -481,163 +1541,366 @@ def below(datadir, outputdir, thr_scale, date_start, date_end):
          20th to August 5th in each year, for all years from 2000 to 2010
          (inclusive).'''
 
-    dts = time.strptime(date_start, '%Y-%m-%d')
-    dte = time.strptime(date_end, '%Y-%m-%d')
-    ys, ye = dts.tm_year, dte.tm_year
-    ms, me = dts.tm_mon,  dte.tm_mon
-    ds, de = dts.tm_mday, dte.tm_mday
-    dstart, dend = dts.tm_yday, dte.tm_yday
+    catalog = scene_catalog(datadir)
+    mask_ds = tile_mask(datadir, catalog.scenes, outputdir)
 
-    pat = re.compile(r'^ndvi(\d+)_(\d+).tiff')
-    for filename in os.listdir(datadir):
-        m = pat.search(filename)
-        if m: break
+    # Scenes of other years are left out by EndSeason.visit anyway
+    years = (time.strptime(date_start, '%Y-%m-%d').tm_year,
+             time.strptime(date_end, '%Y-%m-%d').tm_year)
+    scenes = catalog.select(years=years)
 
-    if not m: raise RuntimeError('No input files found')
+    for window in row_windows(datadir, catalog.scenes, sweep_len(thr_scale)):
+        mask, land = land_pixels(read_window(mask_ds, window))
+        run_years(datadir, scenes, mask_ds,
+                  lambda: [EndSeason(mask_ds, outputdir, mask, thr_scale, date_start, date_end,
+                                     yoff=window[0], land=land)], window, land=land)
+    return 0
 
-    # Use input data source as template to remap mask
-    m_ds = get_remapped_mask(os.path.join(datadir, filename),
-                             os.path.join(permadir, mask_fname))
-    mask = m_ds.ReadAsArray()
-    proj = m_ds.GetProjectionRef()
-    tran = m_ds.GetGeoTransform()
+def seasons(datadir, outputdir, avg_fname, othr_scale, o_start, o_end,
+            ethr_scale, e_start, e_end, statedir=None):
+    '''Growing season onset, peak and end in a single pass over the scenes.
 
-    files = sorted([ x for x in os.listdir(datadir) if pat.match(x) ])
+    Equivalent to running average, above, peak and below in turn, but the
+    mask is remapped once and every scene is read once, except that the
+    scenes of the onset peak period are read a second time for the average
+    on which the onset threshold depends.
 
-    lastyear = -1
-    gs_end = None
-    averaging = 1
-    filelist=[]
+    datadir -- directory containing input files
+    outputdir -- directory wherein to place the result files
+    avg_fname -- name of file where the average for onset is saved
+    othr_scale -- threshold scaling for onset, or a list for a sweep
+    o_start -- 
+    o_end -- date interval for the onset average, see average()
+    ethr_scale -- threshold scaling for end, or a list for a sweep
+    e_start -- 
+    e_end -- date interval for the end average, see below()
+    statedir -- checkpoint directory of the tile, or None
+
+    With a checkpoint directory only the years with new scenes are updated,
+    see run_years.  The sums of the onset average are checkpointed too, and
+    the new scenes of the onset peak period are folded into them; the
+    onset of every year is then computed again from all its scenes, as its
+    threshold changed.  The products of the years updated are the same as
+    those of a run over all scenes without checkpoints.'''
+
+    scenes = list_scenes(datadir)
+    count(scenes=len(scenes))
+    mask_ds = tile_mask(datadir, scenes, outputdir)
+    shape = (mask_ds.RasterYSize, mask_ds.RasterXSize)
+    if statedir is not None:
+        avgdir = os.path.join(statedir, 'average')
+
+    nsweep = max(sweep_len(othr_scale), sweep_len(ethr_scale))
+    for window in row_windows(datadir, scenes, nsweep):
+        yoff = window[0]
+        mask, land = land_pixels(read_window(mask_ds, window))
+
+        acc = PeakAverage(mask, o_start, o_end, yoff)
+        new_avg = True
+        if statedir is None:
+            run_seasons(datadir, scenes, mask_ds, [acc], window, land)
+        else:
+            folded = set(load_state(avgdir, [acc], window, land) or [])
+            nfiles = len(acc.inputs)
+            new = [scene for scene in scenes if scene not in folded]
+            run_seasons(datadir, new, mask_ds, [acc], window, land)
+            new_avg = len(acc.inputs) > nfiles
+            if new: save_state(avgdir, [acc], window, shape, scenes, land)
+            if yoff == 0 and not new_avg:
+                LOGINFO("No new scenes for the onset average")
+        save_average(mask_ds, outputdir, avg_fname, acc.avg, acc.descr, yoff, land)
+        avg_descr = acc.descr
+        thr = scale_threshold(othr_scale, acc.avg.astype(np.float32))
+        acc = None
+
+        run_years(datadir, scenes, mask_ds,
+                  lambda: [OnsetSeason(mask_ds, outputdir, mask, thr, othr_scale, avg_descr,
+                                       yoff=yoff, land=land),
+                           PeakSeason(mask_ds, outputdir, mask, yoff=yoff, land=land),
+                           EndSeason(mask_ds, outputdir, mask, ethr_scale, e_start, e_end,
+                                     yoff=yoff, land=land)],
+                  window, statedir, land, (OnsetSeason,) if new_avg else ())
+    return 0
 
-    for fn in files:
-        try:
-            year, dnum = map(int, pat.match(fn).groups())
-        except:
-            print "File {} not understood".format(fn)
-            bah()
-            continue
 
-        if year+2000 < ys or year+2000 > ye: continue
+def usage(msg):
+    print 'Usage: s2_processtile average datadir outputdir avg_fname [date_start [date_end]]'
+    print 'Usage: s2_processtile above datadir outputdir thr avg_fname'
+    print 'Usage: s2_processtile peak datadir outputdir'
+    print 'Usage: s2_processtile below datadir outputdir thr [date_start [date_end]]'
+    print 'Usage: s2_processtile all datadir outputdir othr ethr [o_start o_end [e_start e_end]]'
+    print 'Thresholds may be lists separated by commas, for a sweep of one band per threshold'
 
-        if year != lastyear:
-            if gs_end is not None:
-                # Done
-                GSE_description = """Arctic/Alpine Growing Season End.
-Computed for the year {year}, using {nfiles} files.
-The growing season has its peak period between the dates {ms:02}-{ds:02} and {me:02}-{de:02} (MM-DD),
-and is defined to end when the daily NDVI value sinks below {thr} times the average over the peak period.
-Files:\n  {fn}""".format(year=2000+lastyear, nfiles=len(filelist), fn="\n  ".join(filelist),
-                thr=thr_scale, ms=ms, ds=ds, me=me, de=de)
-                save_end(src_ds, outputdir, gs_end, lastyear, mask=mask, description=GSE_description)
-                filelist=[]
-            peak_sum = 0 * mask
-            nsets = 0
-            gs_end = mask.copy()
-            lastyear = year
-            averaging = 1
-
-        if dnum < dstart: continue
-
-        src_ds = gdal.Open(os.path.join(datadir, fn), GA_ReadOnly)
-        data = src_ds.ReadAsArray()
-        filelist.append(fn)
-
-        if averaging:
-            if dnum <= dend:
-                peak_sum += data
-                nsets += 1
-                continue
-            else:
-                if nsets == 0: raise RuntimeError('No data in year')
-                peak_average = np.where(peak_sum > 0, peak_sum / nsets, 0)
-                gs_end[np.where(peak_average == 0)] = 390       # No data
-                averaging = 0
+    raise RuntimeError(msg)
 
-        ii = np.where((gs_end == 1) & (data < thr_scale * peak_average))
-        gs_end[ii] = dnum
+def process_tile(url, workdir, settings):
+    '''Compute the growing season products for one tile.
 
+    url -- URL of the list of tarballs of the tile
+    workdir -- scratch directory used for this tile only
+    settings -- (othreshold, o_startdate, o_enddate,
+                 ethreshold, e_startdate, e_enddate); the dates give
+                way to the windows heading the list, if any
 
+    Returns the tile name, workdir, the paths of the products, which are
+    named after the tile, and the metrics of the tile.'''
 
-    # Done
-    GSE_description = """Growth season end for the year {year},
-computed using {nfiles} files.
-The growing season is considered to peak between the dates {ms:02}-{ds:02} and {me:02}-{de:02} (MM-DD),
-and defined to end when the daily NDVI value sinks below {thr} times the average over the peak period.
-Files:\n  {fn}""".format(year=2000+year, nfiles=len(filelist), fn="\n  ".join(filelist),
-                thr=thr_scale, ms=ms, ds=ds, me=me, de=de)
-    save_end(src_ds, outputdir, gs_end, year, mask=mask, description=GSE_description)
+    global _metrics
+    _metrics = {}
+    t0 = time.time()
+    # A worker processes many tiles; without a reset, its peak is that of
+    # its biggest tile so far
+    rss_reset = reset_peak_rss()
 
-    return 0
+    othreshold, o_startdate, o_enddate, ethreshold, e_startdate, e_enddate = settings
+    avg_fname = 'GS_avg.tiff'
 
+    srcdir = os.path.join(workdir, 'inputs')
+    dstdir = os.path.join(workdir, 'outputs')
+    mkdir_p(srcdir)
+    mkdir_p(dstdir)
 
-def usage(msg):
-    print 'Usage: s2_processtile average datadir outputdir avg_fname [date_start [date_end]]'
-    print 'Usage: s2_processtile above datadir outputdir thr avg_fname'
-    print 'Usage: s2_processtile peak datadir outputdir'
-    print 'Usage: s2_processtile below datadir outputdir thr [date_start [date_end]]'
+    window = read_list(fetch(url, srcdir))[1]
+    if window is not None:
+        o_startdate, o_enddate, e_startdate, e_enddate = window
+
+    with timed('unpack'):
+        tile, src_tiledir = copy_and_unpack(url, srcdir, cube_cachedir)
+    dst_tiledir = os.path.join(dstdir, tile)
+    mkdir_p(os.path.join(dst_tiledir))
+
+    # Onset, peak and end in one pass over the scenes
+    LOGINFO("Computing ONSET, PEAK and END for tile " + tile)
+    LOGINFO("Using dates from {0} to {1} for onset".format(o_startdate, o_enddate))
+    LOGINFO("Using dates from {0} to {1} for end".format(e_startdate, e_enddate))
+    statedir = None
+    if season_statedir:
+        statedir = os.path.join(season_statedir, tile)
+    status = seasons(src_tiledir, dst_tiledir, avg_fname,
+                     othreshold, o_startdate, o_enddate,
+                     ethreshold, e_startdate, e_enddate, statedir)
+    release_tile(src_tiledir)
+
+    # Rename results
+    products = []
+    for name in os.listdir(dst_tiledir):
+        if not re.match('GS_(onset|peak|end)_.*\.tiff', name): continue
+
+        old = os.path.join(dst_tiledir, name)
+        new = os.path.join(dstdir, os.path.splitext(name)[0] + '_' + tile + '.tiff')
+
+        os.rename(old, new)
+        products.append(new)
+    rmtree(dst_tiledir)
+    rmtree(srcdir)
+
+    metrics, _metrics = _metrics, None
+    metrics.update(tile=tile, total_s=time.time() - t0, products=len(products))
+    if rss_reset:
+        metrics['peak_rss_mb'] = peak_rss()
+    else:
+        metrics['worker_peak_rss_mb'] = peak_rss()
+    return tile, workdir, products, metrics
+
+class Prefetcher(object):
+    '''Copies the inputs of upcoming tiles in a background thread, while
+    the current ones are processed.
+
+    Iterating over the prefetcher yields the jobs for process_tile, each
+    with a scratch directory where the inputs of the tile were copied.
+    Copying waits while maxtiles tiles are held, counting those being
+    processed, or while the prefetched inputs take maxsize MB or more.
+    done() must be called when a tile is finished with.'''
+
+    def __init__(self, urls, workroot, settings, maxtiles, maxsize=0, threads=1):
+        self.workroot = workroot
+        self.settings = settings
+        self.maxtiles = maxtiles
+        self.maxsize = maxsize * 1024 * 1024
+        self.threads = threads
+        self.sizes = {}
+        self.fetch_times = {}
+        self.locks = {}
+        self.cond = threading.Condition()
+        self.queue = Queue.Queue()
+        thread = threading.Thread(target=self.run, args=(urls,))
+        thread.daemon = True
+        thread.start()
+
+    def full(self):
+        if not self.sizes: return False
+        return len(self.sizes) >= self.maxtiles or \
+               (self.maxsize and sum(self.sizes.values()) >= self.maxsize)
+
+    def run(self, urls):
+        pool = ThreadPool(self.threads) if self.threads > 1 else None
+        try:
+            for url in urls:
+                with self.cond:
+                    while self.full():
+                        self.cond.wait()
+                workdir = tempfile.mkdtemp(dir=self.workroot)
+                t0 = time.time()
+                size, lock = fetch_tile(url, os.path.join(workdir, 'inputs'), pool)
+                with self.cond:
+                    self.sizes[workdir] = size
+                    self.fetch_times[workdir] = time.time() - t0
+                    self.locks[workdir] = lock
+                self.queue.put((url, workdir, self.settings))
+        except Exception:
+            self.queue.put(sys.exc_info())
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            job = self.queue.get()
+            if job is None: return
+            if len(job) == 3 and isinstance(job[1], Exception):
+                raise job[0], job[1], job[2]
+            yield job
+
+    def done(self, workdir):
+        '''Release the inputs of the tile in workdir, and its cached cube.
+
+        Returns the time taken to copy them and their size.'''
+
+        with self.cond:
+            size = self.sizes.pop(workdir, None)
+            seconds = self.fetch_times.pop(workdir, None)
+            lock = self.locks.pop(workdir, None)
+            self.cond.notify()
+        if lock is not None: lock.close()
+        return seconds, size
+
+def split_batch(url, workroot):
+    '''Copy the batch url, and split it into lists of the tarballs of each
+    tile, in the order of the batch, each headed by the date windows of the
+    batch.
+
+    Returns the paths of the lists.'''
+
+    path = fetch(url, os.path.join(workroot, 'batches'))
+    tiledir = tempfile.mkdtemp(dir=os.path.dirname(path))
+    tiles = []
+    header = []
+    for line in open(path):
+        if not line.strip(): continue
+        if line.startswith(window_tag):
+            header.append(line)
+            continue
+        tile = tarball_pattern.search(line.strip()).group(1)
+        flist = os.path.join(tiledir, 'tile_' + tile + '.urls')
+        fd = open(flist, 'a')
+        if flist not in tiles:
+            tiles.append(flist)
+            fd.writelines(header)
+        fd.write(line)
+        fd.close()
+    os.unlink(path)
+    return tiles
+
+def tile_urls(lines, workroot):
+    '''The URLs of the lists of tarballs of the tiles in lines.
+
+    Batches of tiles are split into a list per tile, and the list of the
+    pruned tiles is published on the way.'''
+
+    for line in lines:
+        url = line.strip()
+        if not url: continue
+        if os.path.basename(url) == pruned_fname:
+            LOGINFO("Passing on pruned tiles " + url)
+            publish([fetch(url, workroot)])
+            continue
+        if batch_pattern.search(url):
+            tiles = split_batch(url, workroot)
+            LOGINFO("Batch {0} of {1} tiles".format(url, len(tiles)))
+            for flist in tiles:
+                yield flist
+                os.unlink(flist)        # Copied by the time the next is asked for
+            if tiles: os.rmdir(os.path.dirname(tiles[0]))
+            continue
+        yield url
 
-    raise RuntimeError(msg)
+def process_tile_job(job):
+    return process_tile(*job)
 
 def cluster_main():
+    global mask_cachedir, mask_cachesize, memory_budget, year_workers
+    global cube_cachedir, cube_cachesize, season_statedir, unpack_scenes
+    global metrics_sink, compact_fraction, output_profile
 
-    avg_fname = 'GS_avg.tiff'
     mode       = safe_getparam('mode', 'all')
     if mode != 'all': raise ValueError("Only mode 'all' implemented for now")
 
+    # Only for lists not headed by the windows of the tiling, see window_tag
     o_startdate = safe_getparam('startdate-onset', '1900-07-04')
     o_enddate   = safe_getparam('enddate-onset',   '2500-08-03')
     e_startdate = safe_getparam('startdate-end',   '1925-07-20')
     e_enddate   = safe_getparam('enddate-end',     '2525-08-09')
-    othreshold = float(safe_getparam('othreshold', 0.7))
-    ethreshold = float(safe_getparam('ethreshold', 0.9))
+    othreshold = thresholds(safe_getparam('othreshold', 0.7))
+    ethreshold = thresholds(safe_getparam('ethreshold', 0.9))
+    mask_cachedir  = safe_getparam('maskcache', '') or None
+    mask_cachesize = float(safe_getparam('maskcache-size', mask_cachesize))
+    memory_budget  = float(safe_getparam('memory-budget', memory_budget))
+    cube_cachedir  = safe_getparam('cubecache', '') or None
+    cube_cachesize = float(safe_getparam('cubecache-size', cube_cachesize))
+    workers = int(safe_getparam('workers', 1))
+    year_workers   = int(safe_getparam('year-workers', year_workers))
+    prefetch       = int(safe_getparam('prefetch', 1))
+    prefetch_size  = float(safe_getparam('prefetch-size', 0))
+    fetch_threads  = int(safe_getparam('fetch-threads', 4))
+    season_statedir = safe_getparam('statedir', '') or None
+    unpack_scenes  = safe_getparam('unpack', 'yes').lower() not in ('no', 'false', '0')
+    metrics_sink   = safe_getparam('metrics', metrics_sink)
+    compact_fraction = float(safe_getparam('compact-fraction', compact_fraction))
+    output_profile = gtiff_profiles.tile_profile(safe_getparam('output-profile', output_profile))
 
     LOGINFO("Mode: " + mode)
+    LOGINFO("Processing tiles with {0} workers".format(workers))
+    if season_statedir:
+        LOGINFO("Updating checkpoints in " + season_statedir)
 
     if 'TMPDIR' not in env: env['TMPDIR'] = '/var/tmp'
-    srcdir = os.path.join(env['TMPDIR'], 'innpputs')
-    dstdir = os.path.join(env['TMPDIR'], 'outputs')
-    mkdir_p(srcdir)
-    mkdir_p(dstdir)
+    workroot = os.path.join(env['TMPDIR'], 'tiles')
+    mkdir_p(workroot)
+
+    # The workers are forked before the Prefetcher starts its threads, so
+    # that none of them is forked holding a lock of a thread of the parent
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+
+    # One scratch directory per tile, so that tiles may run concurrently,
+    # holding the inputs of up to prefetch tiles besides those in progress
+    settings = (othreshold, o_startdate, o_enddate, ethreshold, e_startdate, e_enddate)
+    jobs = Prefetcher(tile_urls(sys.stdin, workroot),
+                      workroot, settings, workers + prefetch, prefetch_size, fetch_threads)
 
+    if pool is not None:
+        results = pool.imap_unordered(process_tile_job, jobs)
+    else:
+        results = itertools.imap(process_tile_job, jobs)
+
+    # Publish the results of each tile as soon as it is done
     tiles = []
-    for line in sys.stdin:
-        cleandir(srcdir)
-        tile = copy_and_unpack(line.rstrip(), srcdir)
-        src_tiledir = os.path.join(srcdir, tile)
-        dst_tiledir = os.path.join(dstdir, tile)
-        mkdir_p(os.path.join(dst_tiledir))
-
-        # Onset in two parts: compute average, then find when threshold is exceeded
-        LOGINFO("Computing ONSET for tile " + tile)
-        LOGINFO("Using dates from {0} to {1}".format(o_startdate, o_enddate))
-        status = average(src_tiledir, dst_tiledir, avg_fname, o_startdate, o_enddate)
-        status = above(src_tiledir, dst_tiledir, othreshold, avg_fname)
-
-        # Peak
-        LOGINFO("Computing PEAK for tile " + tile)
-        status = peak(src_tiledir, dst_tiledir)
-
-        # End
-        LOGINFO("Computing END for tile " + tile)
-        LOGINFO("Using dates from {0} to {1}".format(e_startdate, e_enddate))
-        status = below(src_tiledir, dst_tiledir, ethreshold, e_startdate, e_enddate)
-
-        # Rename results
-        for name in os.listdir(dst_tiledir):
-            if not re.match('GS_(onset|peak|end)_.*\.tiff', name): continue
-
-            old = os.path.join(dst_tiledir, name)
-            new = os.path.join(dstdir, os.path.splitext(name)[0] + '_' + tile + '.tiff')
-
-            os.rename(old, new)
-        rmtree(dst_tiledir)
-
-	tiles.append(tile)
-	LOGINFO("Completed results for tile " + tile)
-
-    LOGINFO("Publishing results for tiles " + ", ".join(tiles))
-    # publish(dstdir, recursive=True)
-    publish(glob(dstdir + '/*.tiff'))
+    for tile, workdir, products, metrics in results:
+        LOGINFO("Publishing results for tile " + tile)
+        t0 = time.time()
+        publish(products)
+        metrics['publish_s'] = time.time() - t0
+        rmtree(workdir)
+        metrics['fetch_s'], metrics['fetch_bytes'] = jobs.done(workdir)
+        emit_metrics(metrics)
+        tiles.append(tile)
+        LOGINFO("Completed results for tile " + tile)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     LOGINFO("Published results for tiles " + ", ".join(tiles))
 
 def cmdline_main(args):
@@ -658,19 +1921,28 @@ def cmdline_main(args):
 	    print opcode, datadir, outputdir, avg_fname, date_start, date_end
             return average(datadir, outputdir, avg_fname, date_start, date_end)
         elif opcode.lower() == 'above':
-	    thr_scale = float(args.pop(0))
+	    thr_scale = thresholds(args.pop(0))
             avg_fname = args.pop(0)
 	    print opcode, datadir, outputdir, thr_scale, avg_fname
             return above(datadir, outputdir, thr_scale, avg_fname)
         elif opcode.lower() == 'peak':
             return peak(datadir, outputdir)
         elif opcode.lower() == 'below':
-	    thr_scale = float(args.pop(0))
+	    thr_scale = thresholds(args.pop(0))
             date_start = '1900-07-20'   # default start Jul 20th, all years
             date_end = '2525-08-09'     # default end Aug 5th, all years
             if len(args): date_start = args.pop(0)
             if len(args): date_end = args.pop(0)
             return below(datadir, outputdir, thr_scale, date_start, date_end)
+        elif opcode.lower() == 'all':
+            othr_scale = thresholds(args.pop(0))
+            ethr_scale = thresholds(args.pop(0))
+            o_start, o_end = '1900-07-04', '2525-08-03'
+            e_start, e_end = '1900-07-20', '2525-08-09'
+            if len(args): o_start, o_end = args.pop(0), args.pop(0)
+            if len(args): e_start, e_end = args.pop(0), args.pop(0)
+            return seasons(datadir, outputdir, 'GS_avg.tiff', othr_scale, o_start, o_end,
+                           ethr_scale, e_start, e_end)
         else:
             usage('Unknown command: ' + opcode)
 
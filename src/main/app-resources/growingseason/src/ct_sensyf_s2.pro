@@ -49,8 +49,8 @@
 ;;    GeoTIFF regardless of its projection and geometry.
 ;;
 ;;  - Colorize products
-;;    Using the modified VRT file to add colors to the GeoTIFF is done using the
-;;    python script 'apply_ctab.py'.
+;;    The python script 'merge_products.py' in ../bin reads the color table
+;;    from the ed script, and writes it into the GeoTIFF.
 ;;
 ;;
 ;; ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;; Production ;;;;;;;;;;;;;;;;;;;;;;;;;
@@ -0,0 +1,191 @@
+#!/opt/anaconda/bin/python
+
+'''Time the stages of s2_processtile.py on synthetic tiles.
+
+Every stage runs in a child process of its own, once per combination of
+tile size, scenes per year and number of years, and the best of --repeat
+runs is kept.  The results, with throughput in pixels x scenes per second
+and the peak RSS of the child while the stage ran, are written as JSON.
+Given the results of an earlier run with --baseline, the speed of every
+case is compared to it.
+
+Usage: run_benchmark.py [--sizes 256,512] [--scenes 16] [--years 1,3]
+                        [--stages average,seasons] [--repeat 3]
+                        [--workdir DIR] [--output FILE] [--baseline FILE]'''
+
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from shutil import rmtree
+import numpy as np
+
+from osgeo import gdal
+
+import synth
+
+bindir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '../../main/app-resources/growingseason/bin')
+sys.path.insert(0, bindir)
+import s2_processtile as s2
+
+stages = ['average', 'above', 'peak', 'below', 'seasons', 'encode', 'save_product']
+
+o_start, o_end = '1900-07-04', '2525-08-03'
+e_start, e_end = '1900-07-20', '2525-08-09'
+othr, ethr = 0.7, 0.9
+avg_fname = 'GS_avg.tiff'
+
+def run_stage(stage, tiledir, outdir):
+    '''Run one stage on the tile in tiledir, after whatever it depends on.
+
+    Returns the elapsed time of the stage, the number of pixel scenes it
+    processed, its peak RSS in MB, and whether that peak is of the stage
+    alone: as for the per-tile metrics, the peak is reset after the setup,
+    where Linux allows it, and otherwise counts the setup and imports too.'''
+
+    scenes = s2.list_scenes(tiledir)
+    ds = gdal.Open(os.path.join(tiledir, scenes[0][2]))
+    npix = ds.RasterXSize * ds.RasterYSize
+
+    if stage == 'above':
+        s2.average(tiledir, outdir, avg_fname, o_start, o_end)
+    elif stage in ('encode', 'save_product'):
+        mask_ds = s2.tile_mask(tiledir, scenes, outdir)
+        mask = mask_ds.ReadAsArray()
+        days = np.random.RandomState(0).uniform(100, 300, mask.shape)
+        days[::7] = np.nan
+
+    rss_reset = s2.reset_peak_rss()
+    t0 = time.time()
+    if stage == 'average':
+        s2.average(tiledir, outdir, avg_fname, o_start, o_end)
+    elif stage == 'above':
+        s2.above(tiledir, outdir, othr, avg_fname)
+    elif stage == 'peak':
+        s2.peak(tiledir, outdir)
+    elif stage == 'below':
+        s2.below(tiledir, outdir, ethr, e_start, e_end)
+    elif stage == 'seasons':
+        s2.seasons(tiledir, outdir, avg_fname, othr, o_start, o_end, ethr, e_start, e_end)
+    elif stage == 'encode':
+        s2.encode(np.where(mask == 1, days, mask))
+    elif stage == 'save_product':
+        s2.save_product(mask_ds, outdir, days, 13, mask, 'GTiff',
+                        os.path.join(outdir, 'GS_bench'), 'Benchmark product')
+    elapsed = time.time() - t0
+    rss = s2.peak_rss()
+
+    if stage in ('encode', 'save_product'):
+        return elapsed, npix, rss, rss_reset
+    return elapsed, npix * len(scenes), rss, rss_reset
+
+def child(stage, tiledir, permdir, outdir, conn):
+    s2.LOGINFO = lambda x: None
+    s2.permadir = permdir
+    try:
+        conn.send(run_stage(stage, tiledir, outdir) + (None,))
+    except Exception as e:
+        conn.send((None, None, None, None, repr(e)))
+    conn.close()
+
+def time_stage(stage, tiledir, permdir, workdir):
+    outdir = tempfile.mkdtemp(dir=workdir)
+    try:
+        recv, send = multiprocessing.Pipe(False)
+        proc = multiprocessing.Process(target=child,
+                                       args=(stage, tiledir, permdir, outdir, send))
+        proc.start()
+        result = recv.recv()
+        proc.join()
+    finally:
+        rmtree(outdir)
+    if result[4] is not None:
+        raise RuntimeError('{0} failed: {1}'.format(stage, result[4]))
+    return result[:4]
+
+def case_key(result):
+    return (result['stage'], result['size'], result['scenes'], result['years'])
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=bindir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_fn):
+    baseline = json.load(open(baseline_fn))
+    old = dict((case_key(r), r) for r in baseline['results'])
+    print
+    print 'Compared to {0} ({1}):'.format(baseline_fn, baseline.get('revision'))
+    for r in results:
+        b = old.get(case_key(r))
+        if b is None: continue
+        print '  {0:12} {1:5} px {2:3} scenes {3:2} years: {4:6.2f}x speed, {5:+8.1f} MB RSS'.format(
+            r['stage'], r['size'], r['scenes'], r['years'],
+            b['seconds'] / r['seconds'], r['peak_rss_mb'] - b['peak_rss_mb'])
+
+def int_list(arg):
+    return [int(x) for x in arg.split(',')]
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark the growing season stages.')
+    parser.add_argument('--sizes', type=int_list, default=[256, 512],
+                        help='comma-separated tile sizes (256,512)')
+    parser.add_argument('--scenes', type=int_list, default=[16],
+                        help='comma-separated numbers of scenes per year (16)')
+    parser.add_argument('--years', type=int_list, default=[1, 3],
+                        help='comma-separated numbers of years (1,3)')
+    parser.add_argument('--stages', default=','.join(stages),
+                        help='comma-separated stages ({0})'.format(','.join(stages)))
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case (3)')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'gs_benchmark'),
+                        help='where synthetic tiles are kept between runs')
+    parser.add_argument('--output', default='benchmark.json', help='results file (benchmark.json)')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    opts = parser.parse_args(args)
+
+    for stage in opts.stages.split(','):
+        if stage not in stages: parser.error('Unknown stage ' + stage)
+    if not os.path.isdir(opts.workdir): os.makedirs(opts.workdir)
+
+    results = []
+    for size in opts.sizes:
+        for nscenes in opts.scenes:
+            for nyears in opts.years:
+                tiledir, permdir = synth.generate(opts.workdir, size, nscenes, nyears)
+                for stage in opts.stages.split(','):
+                    runs = [time_stage(stage, tiledir, permdir, opts.workdir)
+                            for i in range(opts.repeat)]
+                    seconds = min(run[0] for run in runs)
+                    result = {'stage': stage, 'size': size, 'scenes': nscenes, 'years': nyears,
+                              'seconds': seconds,
+                              'throughput': runs[0][1] / seconds if seconds else None,
+                              'peak_rss_mb': max(run[2] for run in runs),
+                              'peak_rss_reset': all(run[3] for run in runs)}
+                    results.append(result)
+                    print '{0:12} {1:5} px {2:3} scenes {3:2} years: {4:8.3f} s {5:12.4g} px*scenes/s {6:8.1f} MB'.format(
+                        stage, size, nscenes, nyears, seconds,
+                        result['throughput'] or 0, result['peak_rss_mb'])
+
+    fd = open(opts.output, 'w')
+    json.dump({'revision': revision(),
+               'host': socket.gethostname(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': sys.version.split()[0],
+               'numpy': np.__version__,
+               'gdal': gdal.__version__ if hasattr(gdal, '__version__') else None,
+               'results': results}, fd, indent=1)
+    fd.close()
+
+    if opts.baseline:
+        compare(results, opts.baseline)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+#!/opt/anaconda/bin/python
+
+'''Synthetic NDVI tiles for benchmarking the growing season processing.
+
+A synthetic tile is a directory of ndviYY_DDD.tiff scenes, laid out like the
+tiles unpacked by s2_processtile.py, and a land mask stand-in in the same
+grid.  Land pixels follow a seasonal NDVI curve with noise, water pixels
+stay low, and a fraction of every scene is lost to clouds.  Nothing is
+downloaded; the same arguments always give the same tile.'''
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+from osgeo import gdal, osr
+from osgeo.gdalconst import *
+
+mask_fname = 'maske_sval.tiff'  # Name looked for by s2_processtile.py
+first_year = 13                 # Scenes are named after the year - 2000
+first_day = 120                 # Day numbers of the scenes of a year
+last_day = 290
+
+land, water = 1, 370            # Mask values, see encode() in s2_processtile.py
+cloud = -3000                   # NDVI of cloudy pixels
+
+def tile_name(size, nscenes, nyears, seed):
+    return 'synth_{0}_{1}_{2}_{3}'.format(size, nscenes, nyears, seed)
+
+def grid(size):
+    '''Geotransform and projection of a tile of 250 m pixels on Svalbard.'''
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32633)
+    return (400000.0, 250.0, 0.0, 8800000.0, 0.0, -250.0), srs.ExportToWkt()
+
+def write_tiff(fname, data, tran, proj, gdt=GDT_Int16):
+    driver = gdal.GetDriverByName('GTiff')
+    out = driver.Create(fname, data.shape[1], data.shape[0], 1, gdt)
+    out.SetGeoTransform(tran)
+    out.SetProjection(proj)
+    out.GetRasterBand(1).WriteArray(data)
+    out = None                  # Close and flush file
+
+def make_mask(size, rng):
+    '''Land mask with a coastline along the diagonal and a few lakes.'''
+
+    y, x = np.mgrid[0:size, 0:size]
+    mask = np.where(x + y < size / 2, water, land).astype(np.int16)
+    mask[rng.rand(size, size) < 0.02] = water
+    return mask
+
+def season_days(nscenes):
+    return np.linspace(first_day, last_day, nscenes).astype(int)
+
+def make_scene(dnum, mask, start, end, amp, rng):
+    '''One NDVI scene of a double logistic season, scaled by 10000.'''
+
+    rise = 1 / (1 + np.exp(-(dnum - start) / 8.0))
+    fall = 1 / (1 + np.exp(-(dnum - end) / 8.0))
+    ndvi = 1000 + amp * (rise - fall) + rng.normal(0, 200, mask.shape)
+    ndvi = np.where(mask == land, ndvi, -1000 + rng.normal(0, 100, mask.shape))
+
+    # Clouds come in patches of 16 by 16 pixels
+    clouds = rng.rand(mask.shape[0] / 16 + 1, mask.shape[1] / 16 + 1) < 0.15
+    clouds = np.kron(clouds, np.ones((16, 16), dtype=bool))[:mask.shape[0], :mask.shape[1]]
+    ndvi[clouds] = cloud
+    return ndvi.astype(np.int16)
+
+def generate(outdir, size=256, nscenes=16, nyears=1, seed=0):
+    '''Write a synthetic tile into outdir, unless it is already there.
+
+    outdir -- directory wherein to place the tile
+    size -- number of rows and columns of the tile
+    nscenes -- number of scenes per year
+    nyears -- number of years
+
+    Returns the tile directory and the directory of the mask, which takes
+    the place of the permanent directory of s2_processtile.py.'''
+
+    name = tile_name(size, nscenes, nyears, seed)
+    tiledir = os.path.join(outdir, name)
+    permdir = os.path.join(outdir, name + '_permanent')
+    done = os.path.join(tiledir, 'synth.json')
+    if os.path.exists(done):
+        return tiledir, permdir
+
+    for d in (tiledir, permdir):
+        if not os.path.isdir(d): os.makedirs(d)
+
+    rng = np.random.RandomState(seed)
+    tran, proj = grid(size)
+    mask = make_mask(size, rng)
+    write_tiff(os.path.join(permdir, mask_fname), mask, tran, proj)
+
+    amp = rng.uniform(3000, 7000, mask.shape)
+    for year in range(first_year, first_year + nyears):
+        start = rng.normal(165, 10, mask.shape)
+        end = rng.normal(245, 10, mask.shape)
+        for dnum in season_days(nscenes):
+            data = make_scene(dnum, mask, start, end, amp, rng)
+            write_tiff(os.path.join(tiledir, 'ndvi{0:02}_{1:03}.tiff'.format(year, dnum)),
+                       data, tran, proj)
+
+    fd = open(done, 'w')
+    json.dump({'size': size, 'scenes': nscenes, 'years': nyears, 'seed': seed}, fd)
+    fd.close()
+    return tiledir, permdir
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Write a synthetic NDVI tile.')
+    parser.add_argument('outdir')
+    parser.add_argument('--size', type=int, default=256, help='rows and columns (256)')
+    parser.add_argument('--scenes', type=int, default=16, help='scenes per year (16)')
+    parser.add_argument('--years', type=int, default=1, help='number of years (1)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (0)')
+    opts = parser.parse_args(args)
+
+    tiledir, permdir = generate(opts.outdir, opts.size, opts.scenes, opts.years, opts.seed)
+    print tiledir
+    print permdir
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,483 @@
+#!/opt/anaconda/bin/python
+
+'''The four passes average, above, peak and below of s2_processtile.py as
+they were before the single pass, copied verbatim, for test_seasons.py to
+check the products of the single pass against.
+
+The functions read the scenes straight from datadir and write the
+remapped mask into the current directory, as they always did; set
+permadir to the directory of the land mask before calling them.'''
+
+import os
+import re
+import datetime as dt
+import time
+from shutil import copyfile
+import numpy as np
+
+from osgeo import gdal
+from osgeo.gdalconst import *
+
+mask_fname = 'maske_sval.tiff'
+permadir = None
+
+def LOGINFO(x): pass
+
+def encode(idays):
+  odays = np.minimum(np.maximum(0, idays - 100), 199).astype(np.uint8)
+
+  # Values 370 and above (mask values) map to [200, ...)
+  ii = np.where(idays >= 370)
+  odays[ii] = idays[ii] - 170
+
+  return odays
+
+
+def create_remapped_mask(src_fn, mask_fn, remap_mask_fn):
+
+    copyfile(src_fn, remap_mask_fn)
+    try:
+        src_ds = gdal.Open(mask_fn, GA_ReadOnly)
+    except RuntimeError:
+        mask_fn = os.path.split(mask_fn)[-1]
+        src_ds = gdal.Open(mask_fn, GA_ReadOnly)
+    dst_ds = gdal.Open(remap_mask_fn, GA_Update)
+
+    rmask = dst_ds.ReadAsArray()
+    dst_ds.GetRasterBand(1).WriteArray(0*rmask + 370)   # Fill with water
+
+    gdal.ReprojectImage(src_ds, dst_ds)
+    dst_ds = None
+
+def get_remapped_mask(src_fn, mask_fn, remap_mask_fn='GS_omask.tiff'):
+
+    create_remapped_mask(src_fn, mask_fn, remap_mask_fn)
+
+    ms = gdal.Open(remap_mask_fn)
+    return ms
+
+def average(datadir, outputdir, avg_fname, date_start, date_end):
+    '''Prototype functionality for averaging in SenSyF S2 Service.
+
+    datadir -- where input files are found
+    outputdir -- where files are written
+    avg_fname -- name of file (in permadir) where results (average) should be saved
+    date_start -- 
+    date_end -- date intervals to consider.  The day/month ranges are
+         considered independently from the years, i.e.
+         date_start = '2000-07-04'; date_end = '2010-08-03'
+         will compute the average for the period July 4th to August 3rd 
+         over all years from 2000 to 2010 (inclusive).'''
+
+    dts = time.strptime(date_start, '%Y-%m-%d')
+    dte = time.strptime(date_end, '%Y-%m-%d')
+    ys, ye = dts.tm_year, dte.tm_year
+    ms, me = dts.tm_mon,  dte.tm_mon
+    ds, de = dts.tm_mday, dte.tm_mday
+
+    pat = re.compile(r'^ndvi(\d+)_(\d+)')
+    for filename in os.listdir(datadir):
+        m = pat.search(filename)
+        if m: break
+
+    if not m: raise RuntimeError('No input files found')
+
+
+    # Use input data source as template to remap mask
+    m_ds = get_remapped_mask(os.path.join(datadir, filename),
+                             os.path.join(permadir, mask_fname))
+    mask = m_ds.ReadAsArray()
+    
+    ndat = np.zeros(mask.shape, dtype=np.int16)
+    data = np.zeros(mask.shape, dtype=np.float64)
+
+    inputs = []
+    ymin = ye
+    ymax = ys
+    for filename in os.listdir(datadir):
+        m = pat.search(filename)
+        if not m: continue
+        ynum, dnum = map(int, m.groups())
+        if ynum+2000 < ys or ynum+2000 > ye: continue
+        date = dt.date(ynum+2000, 1, 1) + dt.timedelta(dnum-1)
+        if date < dt.date(ynum+2000, ms, ds) or date > dt.date(ynum+2000, me, de): continue
+        inputs.append(filename)
+        ymin = min(ymin, ynum+2000)
+        ymax = max(ymax, ynum+2000)
+
+        dds = gdal.Open(os.path.join(datadir, filename))
+        ddd = dds.ReadAsArray()
+        xy = np.where(ddd > 0)
+        data[xy] += ddd[xy]
+        ndat[xy] += 1
+        LOGINFO("read file " + filename)
+
+    avg = np.where((mask == 1) & (ndat != 0), data/ndat, np.nan)
+    inputs.sort()
+
+    image_descr = """Average NDVI computed over {nfiles} files.
+The files span the years {ymin} to {ymax},
+and in each year the dates from {ms:02}-{ds:02} to {me:02}-{de:02} (MM-DD).
+
+File names:
+  {flist}""".format(nfiles=len(inputs), ymin=ymin, ymax=ymax,
+        ms=ms, ds=ds, me=me, de=de, flist="\n  ".join(inputs))
+
+    # Create file with average
+    ysize, xsize = avg.shape
+    driver = gdal.GetDriverByName('GTiff')
+    out = driver.Create(os.path.join(outputdir, avg_fname), xsize, ysize, 1, GDT_Float32)
+    out.SetGeoTransform(dds.GetGeoTransform())
+    out.SetProjection(dds.GetProjectionRef())
+    out.SetMetadataItem('TIFFTAG_IMAGEDESCRIPTION', image_descr)
+    out.GetRasterBand(1).WriteArray(avg.astype(np.float32))
+    out = None                # Close and flush file
+    return 0
+
+def save_product(ds, outputdir, data, year, mask, fmt, prod_name, prod_description):
+    ysize, xsize = data.shape
+
+    driver = gdal.GetDriverByName(fmt)
+    if fmt == 'GTiff': prod_name += '.tiff'
+    elif fmt == 'ENVI': prod_name += '.dat'
+    else: raise RuntimeError('Format ' + fmt + ' to be added')
+    out = driver.Create(prod_name, xsize, ysize, 1, GDT_Byte)
+
+    if mask is not None:
+        data = np.where(mask == 1, data, mask)
+
+    out.SetGeoTransform(ds.GetGeoTransform())
+    out.SetProjection(ds.GetProjectionRef())
+    out.SetMetadataItem('TIFFTAG_IMAGEDESCRIPTION', prod_description)
+    # out.SetMetadataItem('band_names', prod_description)
+    rb = out.GetRasterBand(1)
+    # rb.SetDescription(prod_description)
+    rb.WriteArray(encode(data))
+    out = None                  # Close and flush file
+
+    # ff = file(prod_name + '.dat', 'w')
+    # ff.write(data)
+    # ff.close()
+    # hdr['data type'] = 5      # double-float
+    # hdr['interleave'] = 'bsq'
+    # hdr['band names'] = ['Growth season onset']
+
+    # dh.writeHdr(prod_name + '.hdr', hdr)
+    LOGINFO("wrote " + prod_name)
+
+def save_onset(ds, outputdir, onset, year, mask=None, fmt='GTiff', description=''):
+    GSO_name = os.path.join(outputdir, 'GS_onset_{0}'.format(2000+year))
+    save_product(ds, outputdir, onset, year, mask, fmt, GSO_name, description)
+
+def save_peak(ds, outputdir, peak, year, mask=None, fmt='GTiff', description=''):
+    GSP_name = os.path.join(outputdir, 'GS_peak_{0}'.format(2000+year))
+    save_product(ds, outputdir, peak, year, mask, fmt, GSP_name, description)
+
+def save_end(ds, outputdir, end, year, mask=None, fmt='GTiff', description=''):
+    GSE_name = os.path.join(outputdir, 'GS_end_{0}'.format(2000+year))
+    save_product(ds, outputdir, end, year, mask, fmt, GSE_name, description)
+
+def GS_avgpeak(avg_fname):
+
+    gdal.UseExceptions()
+    # avg_fname = 'peak_average.tiff'
+    try:
+      # hdr, avg = dh.read_envi(avg_fname)
+      # junk = open(avg_fname, 'r')   # To provoke IOError
+      ds = gdal.Open(avg_fname, GA_ReadOnly)
+      avg = ds.ReadAsArray()
+    except:
+      return None, None
+
+    return ds, avg
+
+def above(datadir, outputdir, thr_scale, avg_fname):
+    '''Prototype functionality for finding first day above a threshold in SenSyF S2 Service.
+
+    datadir -- directory containing input files
+    outputdir -- directory wherein to place the result files
+    thr_scale -- the scaling of the average which constitutes the threshold
+    avg_fname -- name of file (in permadir) where results (average) has been saved. '''
+
+    pat = re.compile(r'ndvi(\d+)_(\d+).tiff')
+
+    files_used = []
+    for filename in os.listdir(datadir):
+        m = pat.search(filename)
+        if m: break
+
+    if not m: raise RuntimeError('No input files found')
+
+    # Use input data source as template to remap mask
+    mask_ds = get_remapped_mask(os.path.join(datadir, filename),
+                                os.path.join(permadir, mask_fname))
+    mask = mask_ds.ReadAsArray()
+    proj = mask_ds.GetProjectionRef()
+    tran = mask_ds.GetGeoTransform()
+
+    # hdr, avg_peak = GS_avgpeak(datadir)
+    ds, avg_peak = GS_avgpeak(os.path.join(outputdir, avg_fname))
+
+    avg_descr = ds.GetMetadataItem('TIFFTAG_IMAGEDESCRIPTION')
+    LOGINFO("Got avg_peak with shape {0} and dtype {1}".format(avg_peak.shape, avg_peak.dtype))
+    thr = thr_scale * avg_peak
+
+    if ds.GetGeoTransform() != tran \
+       or avg_peak.shape != mask.shape:
+            raise ValueError, "Bogus file: " + avg_fname
+
+    files = sorted([ x for x in os.listdir(datadir) if pat.match(x) ])
+
+    lastyear = -1
+    onset = None
+    # oset = []
+    filelist = []
+    for fn in files:
+        try:
+            year, dnum = map(int, pat.match(fn).groups())
+        except:
+            print "File {} not understood".format(fn)
+            bah()
+            continue
+
+        if year != lastyear:
+            if onset is not None:
+                # save data
+                GSO_description = """Arctic/Alpine Growing Season Onset.
+Computed for the year {year}, using {nfiles} files.
+The growing season onset is defined as the day when the daily NDVI value
+exceeds {thr} times an average over the peak period.
+Files:\n  {fn}""".format(year=2000+year, nfiles=len(filelist),
+                fn="\n  ".join(filelist), thr=thr_scale)
+                save_onset(ds, outputdir, onset, lastyear, mask=mask,
+                    description=GSO_description + '\n\n' + avg_descr)
+                # oset.append(onset)
+                filelist = []
+
+            # onset = np.zeros(data.shape) + np.nan
+            lastdata = None
+
+        # Here, lastdata does not exist if this is first data set in the year
+        lastyear = year
+
+        # hdr, data = dh.read_envi(datadir + fn)
+        ds = gdal.Open(os.path.join(datadir, fn), GA_ReadOnly)
+        data = ds.ReadAsArray()
+        filelist.append(fn)
+        # if ds.GetProjectionRef() != proj \
+        if ds.GetGeoTransform() != tran \
+           or data.shape != mask.shape:
+                raise ValueError, "Bogus file: " + os.path.join(datadir, fn)
+        # print "Read file " + fn
+        if lastdata is None:
+            # First dataset of year
+            # onset[np.where(data > thr)] = dnum
+            onset = np.where(mask == 1, np.nan, mask)
+            onset = np.where(np.isnan(onset) & (data > thr), dnum, onset)
+        else:
+            xy = np.where((data > thr) & np.isnan(onset))
+            if len(xy[0]) != 0:
+                y0 = lastdata[xy]
+                y1 = data[xy]
+                dx = dnum - lastday
+                onset[xy] = lastday + dx*((thr[xy]-y0)/(y1-y0))
+        lastday = dnum
+        lastdata = data
+
+    # Done
+    GSO_description = """Growth season onset for the year {year},
+computed using {nfiles} files.
+The growing season onset is defined as the day when the daily NDVI value
+exceeds {thr} times an average over the peak period.
+Files:\n  {fn}""".format(year=2000+year, nfiles=len(filelist),
+                    fn="\n  ".join(filelist), thr=thr_scale)
+    save_onset(ds, outputdir, onset, year, mask=mask,
+               description=GSO_description + '\n\n' + avg_descr)
+
+    return 0
+
+def peak(datadir, outputdir):
+    '''Prototype functionality for finding day of highest value in SenSyF S2 Service.
+
+    datadir -- directory containing input files
+    outputdir -- directory wherein to place the result files.'''
+
+    pat = re.compile(r'ndvi(\d+)_(\d+).tiff')
+
+    for filename in os.listdir(datadir):
+        m = pat.search(filename)
+        if m: break
+
+    if not m: raise RuntimeError('No input files found')
+
+    # Use input data source as template to remap mask
+    mask_ds = get_remapped_mask(os.path.join(datadir, filename),
+                                os.path.join(permadir, mask_fname))
+    mask = mask_ds.ReadAsArray()
+    proj = mask_ds.GetProjectionRef()
+    tran = mask_ds.GetGeoTransform()
+
+    files = sorted([ x for x in os.listdir(datadir) if pat.match(x) ])
+
+    lastyear = -1
+    peak = None
+    # pk = []
+    filelist = []
+    for fn in files:
+        try:
+            year, dnum = map(int, pat.match(fn).groups())
+        except:
+            print "File {} not understood".format(fn)
+            bah()
+            continue
+
+        if year != lastyear:
+            if peak is not None:
+                # save data
+                GSP_description = """Arctic/Alpine Growing Season Peak.
+Computed for the year {year}, using {nfiles} files.
+The growing season peak is simply the day when the daily NDVI attains its maximum value
+over the entire growing season.
+Files:\n  {fn}""".format(year=2000+year, nfiles=len(filelist), fn="\n  ".join(filelist))
+                save_peak(ds, outputdir, peak, lastyear, mask=mask, description=GSP_description)
+                # pk.append(peak)
+                filelist = []
+
+            # peak = np.zeros(data.shape) + np.nan
+            peakdata = None
+
+        # Here, lastdata does not exist if this is first data set in the year
+        lastyear = year
+        filelist.append(fn)
+
+        # hdr, data = dh.read_envi(datadir + fn)
+        ds = gdal.Open(os.path.join(datadir, fn), GA_ReadOnly)
+        data = ds.ReadAsArray()
+        # if ds.GetProjectionRef() != proj \
+        if ds.GetGeoTransform() != tran \
+           or data.shape != mask.shape:
+                raise ValueError, "Bogus file: peak_average.tiff"
+        # print "Read file " + fn
+        if peakdata is None:
+            # First dataset of year
+            peak = np.where(mask == 1, dnum, mask)
+            peakdata = data
+        else:
+            xy = np.where((data > peakdata) & (mask == 1))
+            if len(xy[0]) != 0:
+                # TODO: fit a parabola
+                peakdata[xy] = data[xy]
+                peak[xy] = dnum
+        # lastday = dnum
+        # lastdata = data
+
+    # Done
+    GSP_description = """Growth season peak for the year {year},
+computed using {nfiles} files.
+Files:\n  {fn}""".format(year=2000+year, nfiles=len(filelist), fn="\n  ".join(filelist))
+    save_peak(ds, outputdir, peak, year, mask=mask, description=GSP_description)
+
+    return 0
+
+def below(datadir, outputdir, thr_scale, date_start, date_end):
+    '''Prototype functionality for finding first day below threshold
+    (after peak) in SenSyF S2 Service.
+
+    datadir -- directory containing input files
+    outputdir -- directory wherein to place the result files
+    thr_scale -- the scaling of the average which constitutes the threshold
+    date_start -- 
+    date_end -- date intervals to consider.  The day/month ranges are
+         considered separately within each year, i.e.
+         date_start = '2000-07-20'; date_end = '2010-08-05'
+         will compute the threshold based on the average for the period July
+         20th to August 5th in each year, for all years from 2000 to 2010
+         (inclusive).'''
+
+    dts = time.strptime(date_start, '%Y-%m-%d')
+    dte = time.strptime(date_end, '%Y-%m-%d')
+    ys, ye = dts.tm_year, dte.tm_year
+    ms, me = dts.tm_mon,  dte.tm_mon
+    ds, de = dts.tm_mday, dte.tm_mday
+    dstart, dend = dts.tm_yday, dte.tm_yday
+
+    pat = re.compile(r'^ndvi(\d+)_(\d+).tiff')
+    for filename in os.listdir(datadir):
+        m = pat.search(filename)
+        if m: break
+
+    if not m: raise RuntimeError('No input files found')
+
+    # Use input data source as template to remap mask
+    m_ds = get_remapped_mask(os.path.join(datadir, filename),
+                             os.path.join(permadir, mask_fname))
+    mask = m_ds.ReadAsArray()
+    proj = m_ds.GetProjectionRef()
+    tran = m_ds.GetGeoTransform()
+
+    files = sorted([ x for x in os.listdir(datadir) if pat.match(x) ])
+
+    lastyear = -1
+    gs_end = None
+    averaging = 1
+    filelist=[]
+
+    for fn in files:
+        try:
+            year, dnum = map(int, pat.match(fn).groups())
+        except:
+            print "File {} not understood".format(fn)
+            bah()
+            continue
+
+        if year+2000 < ys or year+2000 > ye: continue
+
+        if year != lastyear:
+            if gs_end is not None:
+                # Done
+                GSE_description = """Arctic/Alpine Growing Season End.
+Computed for the year {year}, using {nfiles} files.
+The growing season has its peak period between the dates {ms:02}-{ds:02} and {me:02}-{de:02} (MM-DD),
+and is defined to end when the daily NDVI value sinks below {thr} times the average over the peak period.
+Files:\n  {fn}""".format(year=2000+lastyear, nfiles=len(filelist), fn="\n  ".join(filelist),
+                thr=thr_scale, ms=ms, ds=ds, me=me, de=de)
+                save_end(src_ds, outputdir, gs_end, lastyear, mask=mask, description=GSE_description)
+                filelist=[]
+            peak_sum = 0 * mask
+            nsets = 0
+            gs_end = mask.copy()
+            lastyear = year
+            averaging = 1
+
+        if dnum < dstart: continue
+
+        src_ds = gdal.Open(os.path.join(datadir, fn), GA_ReadOnly)
+        data = src_ds.ReadAsArray()
+        filelist.append(fn)
+
+        if averaging:
+            if dnum <= dend:
+                peak_sum += data
+                nsets += 1
+                continue
+            else:
+                if nsets == 0: raise RuntimeError('No data in year')
+                peak_average = np.where(peak_sum > 0, peak_sum / nsets, 0)
+                gs_end[np.where(peak_average == 0)] = 390       # No data
+                averaging = 0
+
+        ii = np.where((gs_end == 1) & (data < thr_scale * peak_average))
+        gs_end[ii] = dnum
+
+
+
+    # Done
+    GSE_description = """Growth season end for the year {year},
+computed using {nfiles} files.
+The growing season is considered to peak between the dates {ms:02}-{ds:02} and {me:02}-{de:02} (MM-DD),
+and defined to end when the daily NDVI value sinks below {thr} times the average over the peak period.
+Files:\n  {fn}""".format(year=2000+year, nfiles=len(filelist), fn="\n  ".join(filelist),
+                thr=thr_scale, ms=ms, ds=ds, me=me, de=de)
+    save_end(src_ds, outputdir, gs_end, year, mask=mask, description=GSE_description)
+
+    return 0
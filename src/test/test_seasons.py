@@ -0,0 +1,156 @@
+#!/opt/anaconda/bin/python
+
+'''Regression test of the single pass of s2_processtile.py.
+
+The onset, peak and end products of seasons(), in all its variants (row
+windows within a memory budget, compacted windows, concurrent years, a
+scene cube, and checkpoints updated with scenes arriving later), must be
+the same rasters as those of the four
+passes average, above, peak and below as they were before the single
+pass, kept verbatim in four_passes.py.  All run on one synthetic tile,
+see benchmark/synth.py.
+
+Usage: test_seasons.py [-v]'''
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import unittest
+from shutil import rmtree
+import numpy as np
+
+from osgeo import gdal
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(testdir, 'benchmark'))
+sys.path.insert(0, os.path.join(testdir, '../main/app-resources/growingseason/bin'))
+import synth
+import four_passes
+import s2_processtile as s2
+
+o_start, o_end = '2013-06-01', '2014-07-15'
+e_start, e_end = '2013-06-20', '2014-08-01'
+othr, ethr = 0.7, 0.9
+avg_fname = 'GS_avg.tiff'
+
+class SinglePassTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        s2.LOGINFO = lambda x: None
+        cls.workdir = tempfile.mkdtemp()
+        cls.tiledir, s2.permadir = synth.generate(cls.workdir, size=96, nscenes=12, nyears=2)
+        four_passes.permadir = s2.permadir
+        cls.baseline = cls.outdir('baseline')
+        # The four passes write the remapped mask into the current directory
+        cwd = os.getcwd()
+        os.chdir(cls.baseline)
+        try:
+            four_passes.average(cls.tiledir, cls.baseline, avg_fname, o_start, o_end)
+            four_passes.above(cls.tiledir, cls.baseline, othr, avg_fname)
+            four_passes.peak(cls.tiledir, cls.baseline)
+            four_passes.below(cls.tiledir, cls.baseline, ethr, e_start, e_end)
+        finally:
+            os.chdir(cwd)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.workdir)
+
+    @classmethod
+    def outdir(cls, name):
+        pth = os.path.join(cls.workdir, name)
+        os.mkdir(pth)
+        return pth
+
+    def run_seasons(self, name, datadir=None, statedir=None, **settings):
+        '''Run seasons() with the module settings of s2_processtile given.'''
+
+        saved = dict((key, getattr(s2, key)) for key in settings)
+        for key, val in settings.items():
+            setattr(s2, key, val)
+        outdir = self.outdir(name)
+        try:
+            s2.seasons(datadir or self.tiledir, outdir, avg_fname, othr, o_start, o_end,
+                       ethr, e_start, e_end, statedir)
+        finally:
+            for key, val in saved.items():
+                setattr(s2, key, val)
+        return outdir
+
+    def assertSameProducts(self, outdir, years=(2013, 2014)):
+        # Onset, peak and end of the years, the average and the mask
+        names = ['GS_avg.tiff', 'GS_omask.tiff'] + \
+                ['GS_{0}_{1}.tiff'.format(prod, year) for prod in ('onset', 'peak', 'end')
+                                                       for year in years]
+        self.assertEqual(sorted(names), sorted(os.path.basename(pth)
+                                               for pth in glob.glob(os.path.join(outdir, 'GS_*.tiff'))))
+        for name in names:
+            expected = gdal.Open(os.path.join(self.baseline, name))
+            actual = gdal.Open(os.path.join(outdir, name))
+            self.assertEqual(expected.GetGeoTransform(), actual.GetGeoTransform(), name)
+            self.assertArrayEqual(expected.ReadAsArray(), actual.ReadAsArray(), name)
+
+    def assertArrayEqual(self, expected, actual, msg):
+        # The onset average is NaN where masked or without data
+        self.assertEqual(expected.shape, actual.shape, msg)
+        same = (expected == actual) | (np.isnan(expected) & np.isnan(actual))
+        self.assertTrue(same.all(), msg)
+
+    def test_single_pass(self):
+        self.assertSameProducts(self.run_seasons('single'))
+
+    def test_windows(self):
+        # A budget of a few rows, and every window compacted to its land
+        outdir = self.run_seasons('windows', memory_budget=0.02, compact_fraction=1.0)
+        self.assertSameProducts(outdir)
+
+    def test_year_workers(self):
+        outdir = self.run_seasons('years', memory_budget=0.02, year_workers=2)
+        self.assertSameProducts(outdir)
+
+    def test_cube(self):
+        # Copied in windows of a few rows
+        cubedir = os.path.join(self.workdir, 'cube')
+        saved, s2.memory_budget = s2.memory_budget, 0.02
+        try:
+            s2.build_cube(self.tiledir, cubedir, 'synth')
+        finally:
+            s2.memory_budget = saved
+        self.assertSameProducts(self.run_seasons('from_cube', cubedir))
+
+    def test_checkpoints(self):
+        statedir = os.path.join(self.workdir, 'state')
+        self.assertSameProducts(self.run_seasons('state', statedir=statedir))
+        # Nothing new for the checkpoints: no year is computed again
+        outdir = self.run_seasons('state_again', statedir=statedir)
+        self.assertEqual(glob.glob(os.path.join(outdir, 'GS_onset_*.tiff')), [])
+
+    def run_later(self, name, later):
+        '''Run seasons() with checkpoints on the tile without the scenes
+        later, then again once they arrived.  Returns the outputs of the
+        second run.'''
+
+        datadir = os.path.join(self.workdir, name + '_tile')
+        statedir = os.path.join(self.workdir, name + '_state')
+        shutil.copytree(self.tiledir, datadir, ignore=shutil.ignore_patterns(*later))
+        self.run_seasons(name + '_first', datadir, statedir)
+        for fn in later:
+            shutil.copy(os.path.join(self.tiledir, fn), datadir)
+        s2.release_tile(datadir)
+        return self.run_seasons(name, datadir, statedir, memory_budget=0.02)
+
+    def test_checkpoints_later(self):
+        # The last scene: 2014 is updated from its checkpoint
+        self.assertSameProducts(self.run_later('later', ['ndvi14_290.tiff']), (2014,))
+
+    def test_checkpoints_onset_average(self):
+        # A scene of the onset peak period: the average and every onset
+        # change, and 2013 gets a scene older than its checkpoint
+        outdir = self.run_later('onset_average', ['ndvi13_166.tiff', 'ndvi14_290.tiff'])
+        self.assertSameProducts(outdir)
+
+if __name__ == '__main__':
+    unittest.main()